@@ -0,0 +1,334 @@
+"""
+Offline benchmark of Telegraph downloads and TelegraphDatabase.
+
+A fake telegra.ph and image host runs in a child process on 127.0.0.1 and is reached through the cloudflare workers
+proxy option, so nothing leaves the machine. Results are written as JSON, pass an older result to `--compare`
+to see how a commit changed them.
+
+    python -m benchmark.bench --galleries 8 --parts 4 --images 20 --latency .05
+    python -m benchmark.bench --compare benchmark/results/<older>.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from functools import wraps
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+from benchmark.fake_telegraph import ServerOptions, start_server
+from src.service import Telegraph, TelegraphDatabase
+from src.service.packer import EpubWriter, ZipPacker
+from src.utils import client_init, close_clients, limiter_init, logger, metrics
+
+_RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+class _Timer:
+    """Seconds spent in wrapped functions, summed over every thread"""
+
+    def __init__(self):
+        self.seconds = 0.
+        self._lock = threading.Lock()
+
+    def wrap(self, func: Callable) -> Callable:
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.seconds += time.perf_counter() - start
+
+        return timed
+
+
+def _usage() -> Dict[str, float]:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return {'cpu_user': usage.ru_utime, 'cpu_system': usage.ru_stime, 'peak_rss_mb': round(rss, 2)}
+
+
+def _summary(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {'total': 0., 'mean': 0., 'p50': 0., 'max': 0.}
+
+    return {
+        'total': round(sum(values), 4),
+        'mean': round(statistics.fmean(values), 4),
+        'p50': round(statistics.median(values), 4),
+        'max': round(max(values), 4)
+    }
+
+
+def _commit() -> Optional[str]:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, check = True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               capture_output = True, text = True).stdout.strip()
+        return f'{commit}-dirty' if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _gallery(gallery: int, args: argparse.Namespace, port: int, root: str, jobs: asyncio.Semaphore) -> Dict:
+    async with jobs:
+        telegraph = Telegraph(
+            f'https://telegra.ph/bench-{gallery}', args.threads,
+            cloudflare_workers_proxy = f'http://127.0.0.1:{port}', root = root
+        )
+        result = {'gallery': gallery, 'ok': False, 'images': 0, 'bytes': 0, 'info': 0., 'download': 0.}
+        start = time.perf_counter()
+
+        try:
+            # the info phase is timed alone, get_zip() and get_epub() skip it once the title is known
+            await telegraph._get_info_handler(is_zip = args.format == 'zip', is_epub = args.format == 'epub')
+            result['info'] = time.perf_counter() - start
+
+            path = await (telegraph.get_zip() if args.format == 'zip' else telegraph.get_epub())
+            result['download'] = time.perf_counter() - start - result['info']
+            result['images'] = len(telegraph._images)
+            result['bytes'] = os.path.getsize(path) if path else 0
+            result['ok'] = path is not None
+        except Exception as e:
+            result['error'] = f'{type(e).__name__}: {e}'
+            logger.warning(f"[Benchmark]: Gallery {gallery} failed: {result['error']}")
+
+        result['total'] = time.perf_counter() - start
+        return result
+
+
+async def bench_telegraph(args: argparse.Namespace, port: int, root: str) -> List[Dict]:
+    pack = _Timer()
+    ZipPacker._write = pack.wrap(ZipPacker._write)
+    ZipPacker._close = pack.wrap(ZipPacker._close)
+    EpubWriter.write = pack.wrap(EpubWriter.write)
+
+    rounds = []
+    for n in range(args.rounds):
+        # later rounds keep the blob store, so they measure linking images downloaded before
+        [shutil.rmtree(os.path.join(root, d), ignore_errors = True) for d in ('komga', 'epub', '.temp')]
+        pack.seconds = 0.
+        retries, failures = metrics.DOWNLOAD_RETRIES.value(), metrics.DOWNLOAD_FAILURES.value()
+        downloaded = metrics.DOWNLOAD_BYTES.value()
+
+        jobs = asyncio.Semaphore(args.jobs)
+        start = time.perf_counter()
+        galleries = await asyncio.gather(*[_gallery(g, args, port, root, jobs) for g in range(args.galleries)])
+        wall = time.perf_counter() - start
+
+        images = sum(g['images'] for g in galleries if g['ok'])
+        rounds.append({
+            'round': n + 1,
+            'wall_seconds': round(wall, 4),
+            'galleries_ok': sum(g['ok'] for g in galleries),
+            'galleries_failed': sum(not g['ok'] for g in galleries),
+            'images': images,
+            'pages_per_sec': round(images / wall, 2),
+            'downloaded_mb': round((metrics.DOWNLOAD_BYTES.value() - downloaded) / 1024 / 1024, 2),
+            'output_mb': round(sum(g['bytes'] for g in galleries) / 1024 / 1024, 2),
+            'retries': int(metrics.DOWNLOAD_RETRIES.value() - retries),
+            'failures': int(metrics.DOWNLOAD_FAILURES.value() - failures),
+            'phases': {
+                'info': _summary([g['info'] for g in galleries]),
+                'download': _summary([g['download'] for g in galleries]),
+                'pack': {'total': round(pack.seconds, 4)},
+                'gallery': _summary([g['total'] for g in galleries])
+            },
+            'errors': [g['error'] for g in galleries if 'error' in g]
+        })
+
+    return rounds
+
+
+async def bench_database(args: argparse.Namespace, root: str) -> Dict[str, Dict]:
+    database = TelegraphDatabase(os.path.join(root, 'telegraph.db'))
+    rows = [
+        database.new({
+            'title': f'Gallery {n}',
+            'file_location': os.path.join(root, 'komga', f'Gallery{n}.zip'),
+            'preview_url': f'https://telegra.ph/bench-{n}',
+            'language': ['chinese' if n % 3 else 'japanese'],
+            'artist': [f'artist {n % 97}'],
+            'team': [f'team {n % 31}'],
+            'original': ['original'],
+            'female': [f'female {n % 13}', f'female {n % 7}'],
+            'others': ['full color'] if n % 2 else None
+        }) for n in range(args.db_rows)
+    ]
+    queries = range(0, args.db_rows, max(args.db_rows // args.db_queries, 1))
+    operations = {
+        'insert': [lambda d = d: database.insert(d) for d in rows],
+        'search_by_title': [lambda n = n: database.search_by_title(f'Gallery {n}') for n in queries],
+        'search': [lambda n = n: database.search(f'Gallery {n} artist') for n in queries],
+        'search_by_tag': [lambda n = n: database.search_by_tag(f'artist {n % 97}') for n in queries],
+        'search_by_tags': [
+            lambda n = n: database.search_by_tags([f'artist:artist {n % 97}', 'language:chinese']) for n in queries],
+        'tags_page': [lambda: database.tags_page(['language:chinese'], limit = 20) for _ in queries],
+        'search_page': [lambda n = n: database.search_page(f'Gallery {n} artist', limit = 20) for n in queries],
+        'random': [database.random for _ in queries],
+        'remove': [lambda n = n: database.remove(n + 1) for n in queries]
+    }
+
+    results = {}
+    for name, calls in operations.items():
+        errors, error = 0, None
+        start = time.perf_counter()
+        for call in calls:
+            try:
+                await call()
+            except Exception as e:
+                errors, error = errors + 1, f'{type(e).__name__}: {e}'
+
+        seconds = time.perf_counter() - start
+        results[name] = {
+            'count': len(calls),
+            'seconds': round(seconds, 4),
+            'ops_per_sec': round(len(calls) / seconds, 2) if seconds else 0.,
+            'errors': errors,
+            'error': error
+        }
+
+    await database.disconnect()
+    return results
+
+
+def compare(base: Dict, current: Dict):
+    def pick(result: Dict) -> Dict[str, float]:
+        values = {f'process.{k}': v for k, v in result['process'].items()}
+        for r in result['telegraph']:
+            values[f"telegraph[{r['round']}].pages_per_sec"] = r['pages_per_sec']
+            values[f"telegraph[{r['round']}].wall_seconds"] = r['wall_seconds']
+            for phase, summary in r['phases'].items():
+                values[f"telegraph[{r['round']}].{phase}.total"] = summary['total']
+        for name, op in result['database'].items():
+            values[f'database.{name}.ops_per_sec'] = op['ops_per_sec']
+        return values
+
+    old, new = pick(base), pick(current)
+    print(f"\n{'metric':<42}{base.get('commit') or 'base':>14}{current.get('commit') or 'current':>14}{'change':>10}")
+    for key in new:
+        if key not in old:
+            continue
+
+        change = f'{(new[key] - old[key]) / old[key] * 100:+.1f}%' if old[key] else '-'
+        print(f'{key:<42}{old[key]:>14}{new[key]:>14}{change:>10}')
+
+
+def report(result: Dict):
+    for r in result['telegraph']:
+        print(
+            f"[round {r['round']}] {r['galleries_ok']}/{r['galleries_ok'] + r['galleries_failed']} galleries, "
+            f"{r['images']} pages in {r['wall_seconds']}s, {r['pages_per_sec']} pages/s, "
+            f"{r['downloaded_mb']} MB downloaded, {r['retries']} retries, {r['failures']} failures"
+        )
+        for phase, summary in r['phases'].items():
+            print(f"    {phase:<10}" + '  '.join(f'{k} {v}s' for k, v in summary.items()))
+
+    for name, op in result['database'].items():
+        errors = f", {op['errors']} errors ({op['error']})" if op['errors'] else ''
+        print(f"[database] {name:<16}{op['count']} ops in {op['seconds']}s, {op['ops_per_sec']} ops/s{errors}")
+
+    p = result['process']
+    print(f"[process] cpu {p['cpu_user']}s user / {p['cpu_system']}s system, peak rss {p['peak_rss_mb']} MB")
+
+
+async def main(args: argparse.Namespace, port: int, root: str) -> Dict:
+    client_init()
+    limiter_init(args.max_threads, args.latency_target)
+
+    before = _usage()
+    start = time.perf_counter()
+    try:
+        telegraph = await bench_telegraph(args, port, root)
+        database = await bench_database(args, root)
+    finally:
+        await close_clients()
+    after = _usage()
+
+    return {
+        'commit': _commit(),
+        'time': datetime.now().isoformat(timespec = 'seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': vars(args),
+        'wall_seconds': round(time.perf_counter() - start, 4),
+        'telegraph': telegraph,
+        'database': database,
+        'process': {
+            'cpu_user': round(after['cpu_user'] - before['cpu_user'], 4),
+            'cpu_system': round(after['cpu_system'] - before['cpu_system'], 4),
+            'peak_rss_mb': after['peak_rss_mb']
+        }
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = 'Offline benchmark of Telegraph downloads and TelegraphDatabase')
+    parser.add_argument('--galleries', type = int, default = 4, help = 'articles downloaded in one round')
+    parser.add_argument('--parts', type = int, default = 4, help = 'pages of every article')
+    parser.add_argument('--images', type = int, default = 20, help = 'images on every page')
+    parser.add_argument('--size', type = int, default = 256 * 1024, help = 'bytes of every image')
+    parser.add_argument('--latency', type = float, default = .05, help = 'seconds before every response')
+    parser.add_argument('--bandwidth', type = int, default = 0, help = 'bytes per second of every response')
+    parser.add_argument('--error-rate', type = float, default = 0., help = 'chance of an image 500')
+    parser.add_argument('--rate-429', type = float, default = 0., help = 'chance of an image 429')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--format', choices = ('zip', 'epub'), default = 'zip')
+    parser.add_argument('--jobs', type = int, default = 2, help = 'galleries downloaded at the same time')
+    parser.add_argument('--threads', type = int, default = 2, help = 'initial concurrency of the image host')
+    parser.add_argument('--max-threads', type = int, default = 8, help = 'maximum concurrency of the image host')
+    parser.add_argument('--latency-target', type = float, default = 5.)
+    parser.add_argument('--rounds', type = int, default = 1, help = 'later rounds reuse the blob store')
+    parser.add_argument('--db-rows', type = int, default = 2000)
+    parser.add_argument('--db-queries', type = int, default = 200)
+    parser.add_argument('--root', help = 'working directory, a temporary one is removed afterwards')
+    parser.add_argument('--output', help = 'result file, default benchmark/results/{time}-{commit}.json')
+    parser.add_argument('--compare', help = 'earlier result file to compare with')
+    parser.add_argument('--verbose', action = 'store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    _args = parse_args()
+    logger.setLevel('DEBUG' if _args.verbose else 'WARNING')
+
+    _server, _port = start_server(ServerOptions(
+        _args.parts, _args.images, _args.size, _args.latency, _args.bandwidth,
+        _args.error_rate, _args.rate_429, _args.seed
+    ))
+    _root = _args.root or tempfile.mkdtemp(prefix = 'neko-bench-')
+
+    try:
+        _result = asyncio.run(main(_args, _port, _root))
+        _result['server'] = httpx.get(f'http://127.0.0.1:{_port}/__stats').json()
+    finally:
+        _server.terminate()
+        shutil.rmtree(_root, ignore_errors = True) if not _args.root else None
+
+    report(_result)
+
+    _output = _args.output or os.path.join(
+        _RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{_result['commit'] or 'unknown'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(_output)), exist_ok = True)
+    with open(_output, 'w') as _f:
+        json.dump(_result, _f, indent = 2, ensure_ascii = False)
+    print(f'\nResult saved to {_output}')
+
+    if _args.compare:
+        with open(_args.compare) as _f:
+            compare(json.load(_f), _result)
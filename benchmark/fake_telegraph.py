@@ -0,0 +1,158 @@
+import asyncio
+import os
+import random
+import re
+import struct
+from dataclasses import dataclass, asdict
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection
+from typing import Dict, Tuple
+
+from aiohttp import web
+
+# '/https://telegra.ph' and '/http://127.0.0.1:port' prefixes left by cloudflare workers proxy urls
+_PROXIED = re.compile(r'^(/https?:/+[^/]+)+')
+_JPEG = b'\xff\xd8\xff\xe0'
+
+
+@dataclass
+class ServerOptions:
+    """
+    parts: Follow-up pages of every article, 1 means a single page article.
+    images: Images on every page.
+    size: Bytes of every image.
+    latency: Seconds before every response starts.
+    bandwidth: Bytes per second of every image response, 0 for unlimited.
+    error_rate: Chance of an image request answered with 500.
+    rate_429: Chance of an image request answered with 429.
+    seed: Seed of the error dice, the same seed fails the same requests.
+    """
+    parts: int = 4
+    images: int = 20
+    size: int = 256 * 1024
+    latency: float = .05
+    bandwidth: int = 0
+    error_rate: float = 0.
+    rate_429: float = 0.
+    seed: int = 0
+
+
+class FakeTelegraph:
+    """
+    telegra.ph and its image host on one local server, reached through the cloudflare workers proxy option.
+
+    '/bench-{g}' is an article titled '[Bench Circle (Bench Artist)] Gallery {g}' that links its pages
+    '/bench-{g}-{p}', every page shows images '/file/{g}-{p}-{i}.jpg'. Images differ from each other by a short
+    header, so content-addressed storage does not collapse them.
+    """
+
+    def __init__(self, options: ServerOptions):
+        self.options = options
+        self.stats: Dict[str, int] = {}
+        self._dice = random.Random(options.seed)
+        self._payload = os.urandom(max(options.size - 16, 0))
+
+    def _count(self, key: str):
+        self.stats[key] = self.stats.get(key, 0) + 1
+
+    def _article(self, gallery: int) -> str:
+        links = ''.join(
+            f'<p><a href="https://telegra.ph/bench-{gallery}-{p}">Part {p}</a></p>' for p in range(self.options.parts))
+        return (
+            f'<html><head><title>[Bench Circle (Bench Artist)] Gallery {gallery} – Telegraph</title></head>'
+            f'<body><article>{links}</article></body></html>'
+        )
+
+    def _page(self, gallery: int, part: int) -> str:
+        images = ''.join(
+            f'<figure><img src="/file/{gallery}-{part}-{i}.jpg"></figure>' for i in range(self.options.images))
+        return (
+            f'<html><head><title>[Bench Circle (Bench Artist)] Gallery {gallery} – Telegraph</title></head>'
+            f'<body><article>{images}</article></body></html>'
+        )
+
+    def _image(self, name: Tuple[int, int, int]) -> bytes:
+        return _JPEG + struct.pack('>3I', *name) + self._payload
+
+    async def _send(self, request: web.Request, body: bytes, content_type: str) -> web.StreamResponse:
+        if not self.options.bandwidth:
+            return web.Response(body = body, content_type = content_type)
+
+        resp = web.StreamResponse(headers = {'Content-Type': content_type})
+        resp.content_length = len(body)
+        await resp.prepare(request)
+
+        chunk = max(self.options.bandwidth // 20, 1024)
+        for start in range(0, len(body), chunk):
+            await resp.write(body[start:start + chunk])
+            await asyncio.sleep(len(body[start:start + chunk]) / self.options.bandwidth)
+
+        await resp.write_eof()
+        return resp
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        path = _PROXIED.sub('', request.raw_path.split('?')[0]) or '/'
+        await asyncio.sleep(self.options.latency)
+
+        if path == '/__stats':
+            return web.json_response(self.stats)
+
+        if m := re.fullmatch(r'/file/(\d+)-(\d+)-(\d+)\.jpg', path):
+            roll = self._dice.random()
+            if roll < self.options.rate_429:
+                self._count('image_429')
+                return web.Response(status = 429, headers = {'Retry-After': '1'})
+            if roll < self.options.rate_429 + self.options.error_rate:
+                self._count('image_500')
+                return web.Response(status = 500)
+
+            self._count('image')
+            return await self._send(request, self._image(tuple(int(n) for n in m.groups())), 'image/jpeg')
+
+        if m := re.fullmatch(r'/bench-(\d+)-(\d+)', path):
+            self._count('page')
+            return await self._send(request, self._page(int(m.group(1)), int(m.group(2))).encode(), 'text/html')
+
+        if m := re.fullmatch(r'/bench-(\d+)', path):
+            self._count('article')
+            if self.options.parts == 1:
+                return await self._send(request, self._page(int(m.group(1)), 0).encode(), 'text/html')
+            return await self._send(request, self._article(int(m.group(1))).encode(), 'text/html')
+
+        self._count('not_found')
+        return web.Response(status = 404)
+
+
+async def _serve(options: ServerOptions, conn: Connection):
+    app = web.Application()
+    app.router.add_route('GET', '/{tail:.*}', FakeTelegraph(options).handle)
+
+    runner = web.AppRunner(app, access_log = None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+
+    conn.send(runner.addresses[0][1])
+    await asyncio.Event().wait()
+
+
+def _main(options: Dict, conn: Connection):
+    asyncio.run(_serve(ServerOptions(**options), conn))
+
+
+def start_server(options: ServerOptions) -> Tuple[Process, int]:
+    """
+    Run the fake server in a child process, so its cpu and memory stay out of the measurements.
+
+    Returns:
+        server process and the local port it listens on
+    """
+    parent, child = Pipe()
+    process = Process(target = _main, args = (asdict(options), child), daemon = True)
+    process.start()
+
+    if not parent.poll(10):
+        process.terminate()
+        raise RuntimeError("Fake Telegraph server did not start in 10 seconds")
+
+    return process, parent.recv()
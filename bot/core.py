@@ -1,19 +1,24 @@
 import asyncio
 import re
+import time
 from io import BytesIO
-from typing import Optional, List
+from typing import Awaitable, Optional, List, Dict, Tuple
 
 from PIL import Image
 from bs4 import BeautifulSoup
 from fake_useragent import UserAgent
 from httpx import Proxy
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import TelegramError
 from telegram.ext import ConversationHandler, ContextTypes, filters
 from urlextract import URLExtract
 
 from src.network_api import ChatAnywhereApi, TraceMoeApi
-from src.service import Telegraph, TelegraphDatabase, AggregationSearch
-from src.utils import logger
+from src.service import (
+    Telegraph, TelegraphDatabase, AggregationSearch, JobStore, JobScheduler, SearchCache, image_hash
+)
+from src.utils import logger, metrics
 
 (KOMGA, GPT_INIT, GPT_OK) = range(3)
 
@@ -78,11 +83,53 @@ class LongSticker:
 
 
 class PandoraBox:
-    def __init__(self, proxy: Optional[Proxy] = None, cloudflare_worker_proxy: Optional[str] = None):
+    def __init__(
+            self,
+            proxy: Optional[Proxy] = None,
+            cloudflare_worker_proxy: Optional[str] = None,
+            search_cache: Optional[SearchCache] = None,
+            search_deadline: Optional[float] = None,
+            search_normalize: bool = False,
+            anime_cache: Optional[SearchCache] = None
+    ):
         self._proxy = proxy
         self._cf_proxy = cloudflare_worker_proxy
+        self._search_cache = search_cache
+        self._search_deadline = search_deadline
+        self._search_normalize = search_normalize
+        self._anime_cache = anime_cache
         self._headers = {'User-Agent': UserAgent().random}
 
+    @staticmethod
+    def _search_reply(results: List[Dict], pending: int) -> Tuple[str, InlineKeyboardMarkup]:
+        m, b = "🔎 _搜索结果_ ", []
+
+        for i, r in enumerate(results):
+            def add_title_button(c: str):
+                if r['title'] and len(r['title']) < 20:
+                    b.append([InlineKeyboardButton(r['title'], r['url'])])
+                elif r['title'] and len(r['title']) >= 20:
+                    b.append([InlineKeyboardButton(f"{r['title'][:20]}...", r['url'])])
+                else:
+                    b.append([InlineKeyboardButton(c, r['url'])])
+
+            m += f" [{i + 1}]({r['url']})"
+            if r["class"] == "iqdb":
+                b.append([InlineKeyboardButton(r['source'], r['url'])])
+            elif r["class"] == "ascii2d":
+                add_title_button("Ascii2D")
+                if r['author'] and len(r['author']) < 20:
+                    b.append([InlineKeyboardButton(r['author'], url = r['author_url'])])
+                elif r['author'] and len(r['author']) >= 20:
+                    b.append([InlineKeyboardButton(f"{r['author'][:20]}...", url = r['author_url'])])
+            elif r["class"] == "google":
+                add_title_button("Google")
+
+        if pending:
+            m += " ⏳"
+
+        return m, InlineKeyboardMarkup(b)
+
     async def parse(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         async def send_epub(url):
             try:
@@ -100,35 +147,27 @@ class PandoraBox:
                 await update.message.reply_text(text = f"出错了: {exc}")
 
         async def search_and_reply(url):
-            results = await AggregationSearch(self._proxy, self._cf_proxy).aggregation_search(url)
-            m, b = "🔎 _搜索结果_ ", []
+            search = AggregationSearch(
+                self._proxy, self._cf_proxy, self._search_cache, normalize = self._search_normalize)
+            message = None
+
+            # reply with the first engine's results, then edit the reply as the others finish
+            async for results, pending in search.progressive_search(url, deadline = self._search_deadline):
+                if not results:
+                    continue
+
+                text, markup = self._search_reply(results, pending)
+                try:
+                    if message:
+                        await message.edit_text(text, parse_mode = ParseMode.MARKDOWN, reply_markup = markup)
+                    else:
+                        message = await update.message.reply_markdown(text, reply_markup = markup)
+                except TelegramError as exc:
+                    logger.warning(f"[PandoraBox]: Failed to update search results: {exc}")
 
-            if not results:
+            if not message:
                 await update.message.reply_text("没有搜到结果 TwT")
-                return ConversationHandler.END
-
-            for i, r in enumerate(results):
-                def add_title_button(c: str):
-                    if r['title'] and len(r['title']) < 20:
-                        b.append([InlineKeyboardButton(r['title'], r['url'])])
-                    elif r['title'] and len(r['title']) >= 20:
-                        b.append([InlineKeyboardButton(f"{r['title'][:20]}...", r['url'])])
-                    else:
-                        b.append([InlineKeyboardButton(c, r['url'])])
-
-                m += f" [{i + 1}]({r['url']})"
-                if r["class"] == "iqdb":
-                    b.append([InlineKeyboardButton(r['source'], r['url'])])
-                elif r["class"] == "ascii2d":
-                    add_title_button("Ascii2D")
-                    if r['author'] and len(r['author']) < 20:
-                        b.append([InlineKeyboardButton(r['author'], url = r['author_url'])])
-                    elif r['author'] and len(r['author']) >= 20:
-                        b.append([InlineKeyboardButton(f"{r['author'][:20]}...", url = r['author_url'])])
-                elif r["class"] == "google":
-                    add_title_button("Google")
-
-            await update.message.reply_markdown(m, reply_markup = InlineKeyboardMarkup(b))
+            return ConversationHandler.END
 
         # start from here
         link_preview = update.message.reply_to_message.link_preview_options
@@ -168,17 +207,47 @@ class PandoraBox:
 
         return ConversationHandler.END
 
+    async def _trace_moe_file(self, context: ContextTypes.DEFAULT_TYPE, file_id: str, unique_id: str) -> List[Dict]:
+        """
+        Search a Telegram image on trace.moe by its bytes, so trace.moe never sees a file link with the bot token.
+        Results are cached under the file_unique_id, found without downloading, and under the image hash.
+        """
+        if self._anime_cache and (cached := await self._anime_cache.get_alias(unique_id)) is not None:
+            return cached
+
+        media = bytes(await (await context.bot.get_file(file_id)).download_as_bytearray())
+        key = None
+        if self._anime_cache:
+            try:
+                key = await asyncio.to_thread(image_hash, media)
+            except OSError as exc:
+                logger.debug(f"[PandoraBox]: No image hash for {unique_id}: {exc}")
+
+            if key is not None and (cached := await self._anime_cache.get(key)) is not None:
+                await self._anime_cache.put(key, cached, unique_id)
+                return cached
+
+        results = await TraceMoeApi(self._proxy, self._cf_proxy).search(media, 'cut_boarder') or []
+        if key is not None and results:
+            await self._anime_cache.put(key, results, unique_id)
+        return results
+
     async def anime_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        async def search_and_reply(url):
+        async def search_and_reply(search: Awaitable[List[Dict]]):
             def format_time(seconds):
                 return f"{int(seconds) // 60}m {int(seconds) % 60}s"
 
-            result = (await TraceMoeApi(self._proxy, self._cf_proxy).search(url, 'cut_boarder'))[0]
+            try:
+                results = await search
+            except RuntimeError as exc:
+                await update.message.reply_text(f"出错了: {exc}")
+                return ConversationHandler.END
 
-            if result['similarity'] <= 0.8:
+            if not results or results[0]['similarity'] <= 0.8:
                 await update.message.reply_text("没有发现搜索结果 XwX")
                 return ConversationHandler.END
 
+            result = results[0]
             anime_url = f"https://anilist.co/anime/{result['anilist']}"
             buttons = [
                 [InlineKeyboardButton("AniList 详情页", url = anime_url)],
@@ -198,16 +267,17 @@ class PandoraBox:
         link_preview = update.message.reply_to_message.link_preview_options
 
         if link_preview:
-            await search_and_reply(link_preview.url)
+            await search_and_reply(TraceMoeApi(self._proxy, self._cf_proxy).search(link_preview.url, 'cut_boarder'))
+            return ConversationHandler.END
 
         if filters.PHOTO.filter(update.message.reply_to_message):
             photo = update.message.reply_to_message.photo[2]
-            await search_and_reply((await context.bot.get_file(photo.file_id)).file_path)
+            await search_and_reply(self._trace_moe_file(context, photo.file_id, photo.file_unique_id))
             return ConversationHandler.END
 
         if filters.Document.IMAGE.filter(update.message.reply_to_message):
-            attachment = update.message.reply_to_message.effective_attachment
-            await search_and_reply((await context.bot.get_file(attachment.thumbnail.file_id)).file_path)
+            thumbnail = update.message.reply_to_message.effective_attachment.thumbnail
+            await search_and_reply(self._trace_moe_file(context, thumbnail.file_id, thumbnail.file_unique_id))
             return ConversationHandler.END
 
         await update.message.reply_text("Neko看了一眼并朝你抛出了一个异常")
@@ -220,76 +290,147 @@ class TelegraphHandler:
             user_id: int = -1,
             thread: int = 1,
             proxy: Optional[Proxy] = None,
-            cloudflare_worker_proxy: Optional[str] = None
+            cloudflare_worker_proxy: Optional[str] = None,
+            jobs: int = 2,
+            jobs_per_host: int = 2,
+            bot: Optional[Bot] = None
     ):
         self._thread = thread
         self._proxy = proxy
         self._cf_proxy = cloudflare_worker_proxy
         self._user_id = user_id
-        self._tasks = asyncio.Queue()
+        # queued links live in sqlite, the event only wakes the main loop up when a new one is added
+        self._jobs = JobStore()
+        self._wakeup = asyncio.Event()
+        self._scheduler = JobScheduler(jobs, jobs_per_host)
+        self._database = TelegraphDatabase()
+        # sends batch summaries, also for batches finished after a restart
+        self._bot = bot
+        metrics.JOBS_RUNNING.set_function(lambda: {(): len(self._scheduler.status()['running'])})
+        metrics.JOBS_PARKED.set_function(lambda: {(): len(self._scheduler.status()['parked'])})
 
         if user_id != -1:
             asyncio.get_event_loop().create_task(self._main_loop())
 
-    async def _main_loop(self):
-        async def worker(queue, n):
-            tasks = [await queue.get() for _ in range(n)]
+    async def _run(self, job: JobStore.Job):
+        start, result = time.monotonic(), 'failure'
 
+        try:
+            telegraph_task = Telegraph(
+                job.url, self._thread, self._proxy, self._cf_proxy,
+                lambda host: self._scheduler.host(job.id, host)
+            )
+
+            packed = None
+            if job.metadata is None or job.batch is not None:
+                # batch jobs only download, the whole batch is recorded at once when its last job ends
+                file_location = await telegraph_task.get_zip()
+                if not file_location:
+                    raise ValueError(f"Failed to pack '{job.url}'")
+
+                packed = {'title': telegraph_task.title, 'file_location': file_location}
+            else:
+                await self._database.insert(self._database.new(job.metadata), telegraph_task)
+
+            await self._jobs.finish(job.id, packed)
+            result = 'success'
+        except Exception as e:
+            logger.error(f"[Core]: Job {job.id} attempt {job.attempts} failed: {e}")
+            await self._jobs.fail(job, str(e))
+        finally:
+            metrics.JOB_SECONDS.observe(result, value = time.monotonic() - start)
+            # a failed job may be queued again
+            self._wakeup.set()
+
+        if job.batch is not None:
             try:
-                await asyncio.gather(*tasks, return_exceptions = True)
+                await self._close_batch(job.batch)
             except Exception as e:
-                logger.error(f"[Core]: {e}")
-            finally:
-                for _ in tasks:
-                    queue.task_done()
+                logger.error(f"[Core]: Failed to close batch {job.batch}: {e}")
+
+    async def _close_batch(self, batch_id: int):
+        closed = await self._jobs.close_batch(batch_id)
+        if not closed:
+            return
+
+        batch, jobs = closed
+        packed = [j for j in jobs if j.result]
+        data = []
+        for job in packed:
+            d = self._database.new(job.metadata or {})
+            d.title, d.file_location = job.result['title'], job.result['file_location']
+            d.preview_url = d.preview_url or job.url
+            data.append(d)
+
+        try:
+            await self._database.insert_many(data) if data else None
+            recorded = "已写入数据库"
+        except Exception as e:
+            logger.error(f"[Core]: Failed to record batch {batch_id}: {e}")
+            recorded = f"写入数据库失败: {e}"
+
+        text = f"批量任务完成: 成功 {len(packed)}/{len(jobs)}, {recorded}"
+        text += ''.join(f"\n❌ {j.url}: {j.error}" for j in jobs if not j.result)
+        text = text if len(text) <= 4000 else text[:4000] + '\n...'
+
+        if self._bot and batch.chat_id:
+            await self._bot.send_message(batch.chat_id, text, reply_to_message_id = batch.message_id)
+        else:
+            logger.info(f"[Core]: {text}")
 
-        idle_count = 0
+    async def _main_loop(self):
+        await self._jobs.recover()
+        # the previous process may have stopped between the last job of a batch and closing it
+        for batch_id in await self._jobs.finished_batches():
+            try:
+                await self._close_batch(batch_id)
+            except Exception as e:
+                logger.error(f"[Core]: Failed to close batch {batch_id}: {e}")
 
         while True:
-            await asyncio.sleep(10) if idle_count >= 20 else await asyncio.sleep(1)
+            await self._scheduler.acquire()
+            self._wakeup.clear()
+            job = await self._jobs.claim()
+            metrics.JOBS_QUEUED.set(value = await self._jobs.count())
 
-            if not self._tasks.empty():
-                idle_count = 0
-                await worker(self._tasks, 1 if self._tasks.qsize() == 1 else 2)
+            if not job:
+                self._scheduler.release()
+                await self._wakeup.wait()
+                continue
 
-            idle_count += 1
+            self._scheduler.start(job.id, job.url, self._run(job))
+
+    async def status(self) -> Dict:
+        """Queue depth and running jobs"""
+        return {'queued': await self._jobs.count(), **self._scheduler.status()}
 
     async def komga_start(self, update: Update, _):
         if update.message.from_user.id != self._user_id:
             await update.message.reply_text(f"だめですよ~, {update.message.from_user.username}")
             return ConversationHandler.END
 
-        msg = f"@{update.message.from_user.username}, 把 telegraph 链接端上来罢 ฅ(＾・ω・＾ฅ)"
+        status = await self.status()
+        msg = (
+            f"@{update.message.from_user.username}, 把 telegraph 链接端上来罢 ฅ(＾・ω・＾ฅ)\n"
+            f"排队中: {status['queued']}, 下载中: {len(status['running'])}/{status['concurrency']}, "
+            f"等待图源: {len(status['parked'])}"
+        )
         await update.message.reply_text(text = msg)
 
         return KOMGA
 
-    async def add_task(self, update: Update, _):
-        if update.message.from_user.id != self._user_id:
-            return KOMGA
-
-        urls = list(set(
-            i for i in URLExtract().find_urls(update.message.text_html_urled)
-            if "telegra.ph" in i
-        ))
-
-        if len(urls) != 1:
-            for u in urls:
-                await self._tasks.put(Telegraph(u, self._thread, self._proxy, self._cf_proxy).get_zip())
-
-            logger.warning(
-                "[CoreFunction]: Multiple urls detected, database won't be updated."
-                f" Source:\n{update.message.text_html_urled}"
-            )
-
-            return KOMGA
-
-        soup = BeautifulSoup(update.message.text_html_urled, "html.parser")
+    @staticmethod
+    def _parse_metadata(html: str) -> Dict:
+        """TelegraphData fields from 'key: #tag#tag' lines of a message block, or the <code> formatted version"""
+        soup = BeautifulSoup(html, "html.parser")
         matches = {}
 
         if not soup.find_all('code'):
-            for line in update.message.text_html_urled.split('\n'):
+            for line in html.split('\n'):
                 line = line.replace('：', ':')
+                if ':' not in line:
+                    continue
+
                 key, value = line.strip().split(':', 1)
                 if key in ["预览", "原始地址"]:
                     value = re.search(r'href="([^"]+)"', line).group(1)
@@ -330,10 +471,55 @@ class TelegraphHandler:
             else:
                 db_dict[new_key] = db_dict.setdefault(new_key, v)
 
-        d_task = TelegraphDatabase()
-        await self._tasks.put(
-            d_task.insert(d_task.new(db_dict), Telegraph(urls[0], self._thread, self._proxy, self._cf_proxy))
-        )
+        return db_dict
+
+    @staticmethod
+    def _find_urls(html: str) -> List[str]:
+        return list(dict.fromkeys(i for i in URLExtract().find_urls(html) if "telegra.ph" in i))
+
+    def _parse_batch(self, html: str) -> List[Tuple[str, Dict]]:
+        """
+        (url, metadata) of every link in a message with several links.
+        Metadata blocks are separated by blank lines, links without a block of their own get no tags.
+        """
+        items = {}
+        for block in re.split(r'\n\s*\n', html):
+            urls = self._find_urls(block)
+            if len(urls) != 1:
+                [items.setdefault(u, {}) for u in urls]
+                continue
+
+            try:
+                items.setdefault(urls[0], self._parse_metadata(block))
+            except (AttributeError, ValueError) as e:
+                logger.warning(f"[CoreFunction]: Failed to parse metadata of '{urls[0]}': {e}")
+                items.setdefault(urls[0], {})
+
+        return list(items.items())
+
+    async def add_task(self, update: Update, _):
+        if update.message.from_user.id != self._user_id:
+            return KOMGA
+
+        urls = self._find_urls(update.message.text_html_urled)
+
+        if len(urls) > 1:
+            items = self._parse_batch(update.message.text_html_urled)
+            await self._jobs.add_batch(items, update.message.chat_id, update.message.message_id)
+            self._wakeup.set()
+            metrics.JOBS_QUEUED.set(value = await self._jobs.count())
+
+            await update.message.reply_text(f"收到 {len(items)} 个链接, 全部完成后会汇总结果 ฅ(＾・ω・＾ฅ)")
+            return KOMGA
+
+        if not urls:
+            return KOMGA
+
+        db_dict = self._parse_metadata(update.message.text_html_urled)
+
+        await self._jobs.add(urls[0], db_dict)
+        self._wakeup.set()
+        metrics.JOBS_QUEUED.set(value = await self._jobs.count())
 
 
 class ChatAnywhereHandler:
@@ -1,3 +1,4 @@
+import asyncio
 import os
 
 from telegram import Update
@@ -21,13 +22,41 @@ from bot import (
     LongSticker,
     TelegraphHandler
 )
-from src.utils import EnvironmentReader, logger, proxy_init
+from src.service import BlobStore, LibraryIndexer, SearchCache, TelegraphDatabase, TempJanitor
+from src.utils import (
+    EnvironmentReader, logger, proxy_init, client_init, close_clients, limiter_init, metrics_init
+)
 
 if __name__ == "__main__":
     async def error_handler(_, context: ContextTypes.DEFAULT_TYPE):
         logger.error(context.error)
 
 
+    async def init_handler(_):
+        await metrics_init(_env.get_variable("METRICS_PORT"), _env.get_variable("METRICS_HOST"))
+
+
+    async def shutdown_handler(_):
+        await close_clients()
+
+
+    async def blob_gc_handler(_):
+        await asyncio.to_thread(BlobStore.shared('/neko/.blob').gc)
+
+
+    async def temp_janitor_handler(_):
+        await asyncio.to_thread(_janitor.sweep)
+
+
+    async def library_index_handler(_):
+        await _library.scan()
+
+
+    async def search_cache_handler(_):
+        await _search_cache.prune()
+        await _anime_cache.prune()
+
+
     _env = EnvironmentReader()
     _proxy = proxy_init(_env.get_variable("PROXY"))
     _cf_proxy = _env.get_variable("CF_WORKER_PROXY")
@@ -37,11 +66,28 @@ if __name__ == "__main__":
     _chat_model = _env.get_variable("CHAT_ANYWHERE_MODEL")
     _chat_prompt = _env.get_variable("CHAT_ANYWHERE_PROMPT")
     _telegraph_thread = _env.get_variable("TELEGRAPH_THREADS")
+    client_init(
+        _env.get_variable("HTTP_MAX_CONNECTIONS"),
+        _env.get_variable("HTTP_MAX_KEEPALIVE"),
+        _env.get_variable("HTTP_KEEPALIVE_EXPIRY"),
+        _env.get_variable("HTTP2")
+    )
+    limiter_init(_env.get_variable("TELEGRAPH_MAX_THREADS"), _env.get_variable("TELEGRAPH_LATENCY_TARGET"))
+    _janitor = TempJanitor.shared(
+        '/neko/.temp', _env.get_variable("TEMP_MAX_AGE") * 3600, _env.get_variable("TEMP_MAX_SIZE") * 1024 * 1024)
+    _search_cache = SearchCache.shared(
+        '/neko/.search.db', _env.get_variable("SEARCH_CACHE_TTL") * 3600, _env.get_variable("SEARCH_CACHE_DISTANCE")
+    ) if _env.get_variable("SEARCH_CACHE_TTL") else None
+    # trace.moe preview links are signed and expire, and near frames of an episode are different scenes
+    _anime_cache = SearchCache.shared(
+        '/neko/.tracemoe.db', min(_env.get_variable("SEARCH_CACHE_TTL") * 3600, 86400.), 0
+    ) if _env.get_variable("SEARCH_CACHE_TTL") else None
     _cmd = _env.BOT_COMMAND
     _base_url = f'{_cf_proxy}/{_env.BASE_URL}' if _cf_proxy else _env.BASE_URL
     _base_file_url = f'{_cf_proxy}/{_env.BASE_FILE_URL}' if _cf_proxy else _env.BASE_FILE_URL
     [os.makedirs(name = d, exist_ok = True, mode = 0o777) for d in _env.WORKING_DIRS]
     os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    _library = LibraryIndexer(TelegraphDatabase(), workers = _env.get_variable("LIBRARY_SCAN_WORKERS"))
 
     # exit if no bot token
     if not _bot_token:
@@ -53,13 +99,17 @@ if __name__ == "__main__":
         ApplicationBuilder().token(_bot_token).
         proxy(_proxy).get_updates_proxy(_proxy).
         pool_timeout(30.).connect_timeout(30.).
-        base_url(_base_url).base_file_url(_base_file_url).build()
+        base_url(_base_url).base_file_url(_base_file_url).
+        post_init(init_handler).post_shutdown(shutdown_handler).build()
     )
 
     # core function: Send Long Sticker
     long = LongSticker(_proxy, _cf_proxy)
     # core function: Parse contents based on reply
-    pandora = PandoraBox(_proxy, _cf_proxy)
+    pandora = PandoraBox(
+        _proxy, _cf_proxy, _search_cache,
+        _env.get_variable("SEARCH_ENGINE_DEADLINE"), _env.get_variable("SEARCH_NORMALIZE"), _anime_cache
+    )
 
     neko_chan.add_handler(CommandHandler(_cmd['👀'], introduce))
     neko_chan.add_handler(CommandHandler(_cmd['❔'], instructions))
@@ -71,7 +121,10 @@ if __name__ == "__main__":
         logger.info("[Main]: User ID not set, telegraph syncing service will not work.")
     else:
         # core function: Sync Telegraph manga
-        telegraph = TelegraphHandler(_user_id, _telegraph_thread, _proxy, _cf_proxy)
+        telegraph = TelegraphHandler(
+            _user_id, _telegraph_thread, _proxy, _cf_proxy,
+            _env.get_variable("TELEGRAPH_JOBS"), _env.get_variable("TELEGRAPH_JOBS_PER_HOST"), neko_chan.bot
+        )
         telegraph_monitor = ConversationHandler(
             entry_points = [CommandHandler(_cmd['📖'], telegraph.komga_start)],
             states = {KOMGA: [MessageHandler(filters.TEXT, telegraph.add_task)]},
@@ -93,6 +146,19 @@ if __name__ == "__main__":
     )
     neko_chan.add_handler(lets_chat)
 
+    # drop stored images no archive refers to anymore
+    neko_chan.job_queue.run_repeating(blob_gc_handler, interval = 86400, first = 600)
+    # clean download dirs of finished or abandoned jobs
+    neko_chan.job_queue.run_repeating(temp_janitor_handler, interval = 3600, first = 60)
+    # add archives copied into the library by hand, only changed files are read again
+    if _env.get_variable("LIBRARY_SCAN_INTERVAL"):
+        neko_chan.job_queue.run_repeating(
+            library_index_handler, interval = _env.get_variable("LIBRARY_SCAN_INTERVAL") * 3600, first = 120)
+
+    # drop expired reverse search results
+    if _search_cache:
+        neko_chan.job_queue.run_repeating(search_cache_handler, interval = 86400, first = 900)
+
     # error handler (no use now)
     neko_chan.add_error_handler(error_handler)
 
@@ -1,7 +1,9 @@
 import json
 from typing import Optional, List, Dict
 
-from httpx import Proxy, AsyncClient, HTTPStatusError, RequestError
+from httpx import Proxy, HTTPStatusError, RequestError
+
+from src.utils import get_client, metrics
 
 
 class ChatAnywhereApi:
@@ -34,7 +36,8 @@ class ChatAnywhereApi:
 
         async def _handle_request(request_func) -> json:
             try:
-                response = await request_func()
+                with metrics.API_SECONDS.time('chatanywhere', endpoint):
+                    response = await request_func()
                 response.raise_for_status()
                 return response.json()
             except HTTPStatusError as e:
@@ -54,13 +57,14 @@ class ChatAnywhereApi:
         elif auth_type == 1:
             headers['Authorization'] = self._token
 
-        async with AsyncClient(proxies = self._proxy, headers = headers) as client:
-            if method == 'GET':
-                return await _handle_request(lambda: client.get(f"{self._base_url}/{endpoint}"))
-            elif method == 'POST':
-                return await _handle_request(lambda: client.post(f"{self._base_url}/{endpoint}", content = payload))
-            else:
-                raise ValueError("无效的 HTTP 方法")
+        client = get_client(self._base_url, self._proxy)
+        if method == 'GET':
+            return await _handle_request(lambda: client.get(f"{self._base_url}/{endpoint}", headers = headers))
+        elif method == 'POST':
+            return await _handle_request(
+                lambda: client.post(f"{self._base_url}/{endpoint}", content = payload, headers = headers))
+        else:
+            raise ValueError("无效的 HTTP 方法")
 
     async def list_model(self) -> List[Dict]:
         return (await self._request('GET', 'v1/models'))['data']
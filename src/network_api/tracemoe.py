@@ -1,11 +1,18 @@
-from typing import Optional
+import time
+from typing import Dict, Optional
 from urllib.parse import quote_plus
 
 from fake_useragent import UserAgent
-from httpx import AsyncClient, Proxy
+from httpx import Proxy, HTTPError, Response
+
+from src.utils import get_client, logger, metrics
 
 
 class TraceMoeApi:
+    # quota and rate limit of our account (or IP) at trace.moe, shared by every instance
+    _quota: Dict[str, float] = {'quota': 0, 'used': 0, 'checked': 0., 'blocked_until': 0.}
+    _quota_refresh = 600.
+
     def __init__(self, proxy: Optional[Proxy] = None, cf_proxy: Optional[str] = None):
         def construct(endpoint: str) -> str:
             _base = "https://api.trace.moe"
@@ -13,55 +20,111 @@ class TraceMoeApi:
 
         endpoints = {
             "📄": "search",
+            "📄-⬛": "search?cutBorders",
             "🔗": "search?url={}",
             "🔗-⬛": "search?cutBorders&url={}",
-            "🔗+📺": "search?anilistInfo&url={}"
+            "🔗+📺": "search?anilistInfo&url={}",
+            "👤": "me"
         }
 
         self._search_file = construct(endpoints["📄"])
+        self._search_file_cut_border = construct(endpoints["📄-⬛"])
         self._search_url = construct(endpoints["🔗"])
         self._search_url_cut_border = construct(endpoints["🔗-⬛"])
         self._search_url_anilist = construct(endpoints["🔗+📺"])
+        self._me = construct(endpoints["👤"])
         self._proxy = proxy
 
+    @classmethod
+    def _block(cls, until: float, reason: str):
+        cls._quota['blocked_until'] = max(cls._quota['blocked_until'], until)
+        logger.warning(f"[TraceMoe]: {reason}, searches paused for {round(until - time.time())}s")
+
+    def _track(self, resp: Response):
+        """Count a search and stop before the next one would be refused"""
+        if resp.status_code == 402:
+            # quota used up or too many searches at once, /me tells which once the pause is over
+            self._quota['checked'] = 0.
+            self._block(time.time() + 60, "Search refused with 402")
+            return
+
+        if resp.is_success:
+            self._quota['used'] += 1
+        if resp.headers.get('x-ratelimit-remaining') == '0' and resp.headers.get('x-ratelimit-reset'):
+            self._block(float(resp.headers['x-ratelimit-reset']), "Rate limit reached")
+
+    async def quota(self) -> Dict[str, float]:
+        """
+        搜索额度，每 10 分钟从 /me 刷新一次，之间按本地搜索次数累计
+
+        Returns:
+            {'quota': 总额度, 'used': 已用额度, 'checked': 上次刷新时间, 'blocked_until': 暂停搜索直到该时间}
+        """
+        if time.time() - self._quota['checked'] > self._quota_refresh:
+            try:
+                client = get_client(self._me, self._proxy)
+                resp = await client.get(self._me, headers = {"User-Agent": UserAgent().random})
+                resp.raise_for_status()
+                me = resp.json()
+                self._quota.update(quota = me['quota'], used = me['quotaUsed'], checked = time.time())
+            except (HTTPError, ValueError, KeyError) as exc:
+                logger.debug(f"[TraceMoe]: Failed to refresh quota: {exc}")
+
+        return dict(self._quota)
+
     async def _search(self, call: str, url: str = None, data: bytes = None):
+        quota = await self.quota()
+        if time.time() < quota['blocked_until']:
+            raise RuntimeError("trace.moe 搜索暂时受限，请稍后再试")
+        if quota['quota'] and quota['used'] >= quota['quota']:
+            raise RuntimeError("trace.moe 本月搜索额度已用完")
+
         headers = {"User-Agent": UserAgent().random}
-        if url:
+        if data:
             headers["Content-Type"] = "application/octet-stream"
 
-        async with AsyncClient(proxy = self._proxy, headers = headers) as client:
+        client = get_client(call, self._proxy)
+        with metrics.API_SECONDS.time('tracemoe', 'search'):
             if url:
-                resp = await client.get(call.format(quote_plus(url)))
+                resp = await client.get(call.format(quote_plus(url)), headers = headers)
             else:
-                resp = await client.post(call, data = data)
+                resp = await client.post(call, content = data, headers = headers)
 
-            resp.raise_for_status()
-            result = resp.json()
-            if result.get("error"):
-                raise Exception(result["error"])
+        self._track(resp)
+        if resp.status_code in (402, 429):
+            # refused searches get the same answer as ones stopped before sending
+            raise RuntimeError("trace.moe 搜索暂时受限，请稍后再试")
+        resp.raise_for_status()
+        result = resp.json()
+        if result.get("error"):
+            raise Exception(result["error"])
 
-            return result.get("result")
+        return result.get("result")
 
     async def search(self, *arg: str | bytes):
         """
         搜索方法，根据传入的参数类型和值进行不同类型的搜索
 
         Args:
-            *arg: 可变参数，支持 str 和 bytes 类型, 当第一个参数为 str 时，第二个参数可选 "cut_boarder" 或 "anilist"
+            *arg: 可变参数，支持 str 和 bytes 类型, 第二个参数可选 "cut_boarder"，链接搜索还可选 "anilist"
 
         Returns:
             搜索结果
 
         Raises:
             ValueError: 如果传入的参数类型或值不正确
+            RuntimeError: 搜索额度用完或达到频率限制
 
         Examples:
             >>> api = TraceMoeApi()
             >>> api.search("https://example.com/image.jpg")
             >>> api.search("https://example.com/image.jpg", "cut_boarder")
             >>> api.search(b"image_data")
+            >>> api.search(b"image_data", "cut_boarder")
         """
-        if len(arg) == 2 and isinstance(arg[1], str):
+        if len(arg) == 2 and isinstance(arg[0], bytes) and arg[1] == 'cut_boarder':
+            return await self._search(self._search_file_cut_border, data = arg[0])
+        elif len(arg) == 2 and isinstance(arg[0], str) and isinstance(arg[1], str):
             if arg[1] == 'cut_boarder':
                 return await self._search(self._search_url_cut_border, arg[0])
             elif arg[1] == 'anilist':
@@ -71,6 +134,6 @@ class TraceMoeApi:
         elif len(arg) == 1 and isinstance(arg[0], str):
             return await self._search(self._search_url, arg[0])
         elif len(arg) == 1 and isinstance(arg[0], bytes):
-            return await self._search(self._search_file, arg[0])
+            return await self._search(self._search_file, data = arg[0])
         else:
             raise ValueError("Invalid argument")
@@ -1,4 +1,10 @@
 # __init__.py
 
+from .blob_store import BlobStore
+from .janitor import TempJanitor
+from .job_store import JobStore
+from .library import LibraryIndexer
 from .reverse_search import AggregationSearch
+from .scheduler import JobScheduler
+from .search_cache import SearchCache, image_hash
 from .telegraph import Telegraph, TelegraphDatabase
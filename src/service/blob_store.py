@@ -0,0 +1,183 @@
+import asyncio
+import os
+import shutil
+import threading
+import time
+from sqlite3 import connect
+from typing import Dict, Optional, Tuple
+
+from src.utils import logger
+
+
+class BlobStore:
+    """
+    Content-addressed image store shared by all Telegraph jobs.
+
+    Images live once under '{root}/objects/{sha256[:2]}/{sha256}' and are hard-linked into job download dirs.
+    The index maps source urls to hashes and counts references, a reference being the archive (owner) the image
+    was packed into. `gc()` drops references of archives that no longer exist and deletes unreferenced blobs.
+    """
+    _shared: Dict[str, 'BlobStore'] = {}
+
+    def __init__(self, root: str):
+        self._root = root
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, 'objects'), exist_ok = True)
+
+        self._database = connect(os.path.join(root, 'index.db'), check_same_thread = False)
+        self._database.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                refs INTEGER NOT NULL DEFAULT 0,
+                time_added REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL REFERENCES blobs(sha256)
+            );
+            CREATE TABLE IF NOT EXISTS refs (
+                owner TEXT NOT NULL,
+                sha256 TEXT NOT NULL REFERENCES blobs(sha256),
+                time_added REAL NOT NULL,
+                PRIMARY KEY (owner, sha256)
+            );
+            CREATE INDEX IF NOT EXISTS idx_urls_sha256 ON urls (sha256);
+            CREATE INDEX IF NOT EXISTS idx_refs_sha256 ON refs (sha256);
+            CREATE INDEX IF NOT EXISTS idx_blobs_refs ON blobs (refs);
+            """
+        )
+
+    @classmethod
+    def shared(cls, root: str) -> 'BlobStore':
+        """Process-wide store for `root`"""
+        if root not in cls._shared:
+            cls._shared[root] = cls(root)
+
+        return cls._shared[root]
+
+    def _blob(self, sha256: str) -> str:
+        return os.path.join(self._root, 'objects', sha256[:2], sha256)
+
+    @staticmethod
+    def _link(src: str, dst: str):
+        tmp = f"{dst}.part"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+        try:
+            os.link(src, tmp)
+        except OSError:
+            # different filesystem or no hard link support
+            shutil.copyfile(src, tmp)
+
+        os.replace(tmp, dst)
+
+    def _ref(self, owner: str, sha256: str):
+        cursor = self._database.execute(
+            "INSERT OR IGNORE INTO refs (owner, sha256, time_added) VALUES (?, ?, ?)", (owner, sha256, time.time()))
+        if cursor.rowcount:
+            self._database.execute("UPDATE blobs SET refs = refs + 1 WHERE sha256 = ?", (sha256,))
+
+    def _get(self, url: str, dest: str, owner: str) -> Optional[Tuple[int, str]]:
+        with self._lock:
+            row = self._database.execute(
+                "SELECT blobs.sha256, blobs.size FROM urls JOIN blobs ON urls.sha256 = blobs.sha256 WHERE url = ?",
+                (url,)
+            ).fetchone()
+
+            if not row or not os.path.exists(self._blob(row[0])):
+                return None
+
+            self._link(self._blob(row[0]), dest)
+            self._ref(owner, row[0])
+            self._database.commit()
+            return row[1], row[0]
+
+    def _put(self, url: str, path: str, size: int, sha256: str, owner: str):
+        with self._lock:
+            blob = self._blob(sha256)
+            if os.path.exists(blob):
+                # same content from another url, keep a single copy on disk
+                self._link(blob, path)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok = True)
+                self._link(path, blob)
+
+            self._database.execute(
+                "INSERT OR IGNORE INTO blobs (sha256, size, time_added) VALUES (?, ?, ?)", (sha256, size, time.time()))
+            self._database.execute("INSERT OR REPLACE INTO urls (url, sha256) VALUES (?, ?)", (url, sha256))
+            self._ref(owner, sha256)
+            self._database.commit()
+
+    async def get(self, url: str, dest: str, owner: str) -> Optional[Tuple[int, str]]:
+        """
+        Hard-link the stored image of `url` to `dest` and reference it from `owner`.
+
+        Returns:
+            (size, sha256) of the image, None if `url` is not in the store
+        """
+        return await asyncio.to_thread(self._get, url, dest, owner)
+
+    async def put(self, url: str, path: str, size: int, sha256: str, owner: str):
+        """Add a downloaded image to the store and reference it from `owner`"""
+        await asyncio.to_thread(self._put, url, path, size, sha256, owner)
+
+    def find(self, url: Optional[str] = None, sha256: Optional[str] = None) -> Optional[Dict]:
+        """Look up a blob by source url or by hash"""
+        with self._lock:
+            row = self._database.execute(
+                """
+                SELECT blobs.sha256, size, refs, time_added FROM blobs
+                WHERE blobs.sha256 = COALESCE(?, (SELECT sha256 FROM urls WHERE url = ?))
+                """,
+                (sha256, url)
+            ).fetchone()
+
+        return dict(zip(('sha256', 'size', 'refs', 'time_added'), row)) if row else None
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            blobs, size = self._database.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+            urls = self._database.execute("SELECT COUNT(*) FROM urls").fetchone()[0]
+            refs = self._database.execute("SELECT COUNT(*) FROM refs").fetchone()[0]
+
+        return {'blobs': blobs, 'bytes': size, 'urls': urls, 'refs': refs}
+
+    def release(self, owner: str):
+        """Drop every reference held by `owner`"""
+        with self._lock:
+            self._database.execute(
+                "UPDATE blobs SET refs = refs - 1 WHERE sha256 IN (SELECT sha256 FROM refs WHERE owner = ?)", (owner,))
+            self._database.execute("DELETE FROM refs WHERE owner = ?", (owner,))
+            self._database.commit()
+
+    def gc(self, grace: float = 86400.) -> Tuple[int, int]:
+        """
+        Release owners whose archive is gone and delete blobs nobody references, blocking.
+        Owners younger than `grace` seconds are kept, their archive may still be in progress.
+
+        Returns:
+            number of blobs and bytes removed
+        """
+        with self._lock:
+            owners = self._database.execute(
+                "SELECT DISTINCT owner FROM refs WHERE time_added < ?", (time.time() - grace,)).fetchall()
+
+        [self.release(owner) for (owner,) in owners if not os.path.exists(owner)]
+
+        with self._lock:
+            removed = self._database.execute("SELECT sha256, size FROM blobs WHERE refs <= 0").fetchall()
+            for sha256, _ in removed:
+                if os.path.exists(self._blob(sha256)):
+                    os.remove(self._blob(sha256))
+
+            self._database.executemany("DELETE FROM urls WHERE sha256 = ?", [(r[0],) for r in removed])
+            self._database.executemany("DELETE FROM blobs WHERE sha256 = ?", [(r[0],) for r in removed])
+            self._database.commit()
+
+        freed = sum(r[1] for r in removed)
+        logger.info(f"[BlobStore]: Collected {len(removed)} unreferenced images, {freed} bytes freed")
+        return len(removed), freed
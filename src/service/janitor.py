@@ -0,0 +1,125 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Set, Tuple
+
+from src.utils import logger
+
+
+class TempJanitor:
+    """
+    Clean up download dirs left in the temp folder, meant to run periodically in a worker thread.
+
+    `sweep()` removes dirs unused for longer than `max_age` seconds, then evicts the least recently used ones
+    until the folder fits in `budget` bytes. Dirs of running jobs are registered with `active()` and never touched.
+    """
+    _shared: Dict[str, 'TempJanitor'] = {}
+
+    def __init__(self, root: str, max_age: float = 86400., budget: int = 0):
+        self._root = root
+        self.max_age = max_age
+        self.budget = budget  # 0 means no size limit
+        self._active: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, root: str, max_age: float = 86400., budget: int = 0) -> 'TempJanitor':
+        """Process-wide janitor of `root`, `max_age` and `budget` are only used when it is created"""
+        if root not in cls._shared:
+            cls._shared[root] = cls(root, max_age, budget)
+
+        return cls._shared[root]
+
+    @contextmanager
+    def active(self, path: str):
+        """Keep `path` from being cleaned while the block runs"""
+        path = os.path.abspath(path)
+        with self._lock:
+            self._active[path] = self._active.get(path, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active[path] -= 1
+                if not self._active[path]:
+                    del self._active[path]
+
+    def _usage(self) -> List[Tuple[str, float, int]]:
+        """(path, last used time, bytes freed by removing it) of every dir in root"""
+        dirs = []
+        try:
+            entries = [e for e in os.scandir(self._root) if e.is_dir(follow_symlinks = False)]
+        except FileNotFoundError:
+            return dirs
+
+        for entry in entries:
+            used, size = entry.stat(follow_symlinks = False).st_mtime, 0
+            for root, _, files in os.walk(entry.path):
+                for name in files:
+                    try:
+                        stat = os.stat(os.path.join(root, name), follow_symlinks = False)
+                    except FileNotFoundError:
+                        continue
+
+                    # pages linked from the blob store stay on disk after the dir is gone
+                    used = max(used, stat.st_mtime)
+                    size += stat.st_size if stat.st_nlink == 1 else 0
+
+            dirs.append((os.path.abspath(entry.path), used, size))
+
+        return dirs
+
+    def _remove(self, path: str) -> bool:
+        # move it out of the way while holding the lock, a job starting on the same path gets a fresh dir
+        with self._lock:
+            if path in self._active:
+                return False
+
+            trash = os.path.join(self._root, f".trash-{uuid.uuid4().hex}")
+            try:
+                os.rename(path, trash)
+            except FileNotFoundError:
+                return False
+
+        shutil.rmtree(trash, ignore_errors = True)
+        return True
+
+    def sweep(self) -> Tuple[int, int]:
+        """
+        Remove expired dirs, then evict least recently used ones above the budget, blocking.
+
+        Returns:
+            number of dirs and bytes removed
+        """
+        usage = self._usage()
+        # trash left by an interrupted sweep
+        [shutil.rmtree(d[0], ignore_errors = True) for d in usage if os.path.basename(d[0]).startswith('.trash-')]
+        usage = [d for d in usage if not os.path.basename(d[0]).startswith('.trash-')]
+
+        with self._lock:
+            active: Set[str] = set(self._active)
+
+        # oldest first, so expired dirs go before the budget is checked
+        dirs = sorted((d for d in usage if d[0] not in active), key = lambda d: d[1])
+        total = sum(d[2] for d in usage)
+        removed = freed = 0
+        now = time.time()
+
+        for path, used, size in dirs:
+            expired = now - used > self.max_age
+            if not expired and (not self.budget or total <= self.budget):
+                break
+
+            if self._remove(path):
+                logger.debug(f"[TempJanitor]: Removed '{path}' ({'expired' if expired else 'over budget'})")
+                removed, freed, total = removed + 1, freed + size, total - size
+
+        if removed:
+            logger.info(f"[TempJanitor]: Removed {removed} temp dirs, {freed} bytes freed")
+        if self.budget and total > self.budget:
+            logger.warning(f"[TempJanitor]: Temp dirs of running jobs take {total} bytes, over budget {self.budget}")
+
+        return removed, freed
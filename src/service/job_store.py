@@ -0,0 +1,247 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from sqlite3 import connect
+from typing import Dict, List, Optional, Tuple
+
+from src.utils import logger
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+OPEN, CLOSED = 'open', 'closed'
+
+
+class JobStore:
+    """Persistent queue of Telegraph sync jobs, survives bot restarts."""
+
+    @dataclass
+    class Job:
+        """
+        id: Primary key of the job.
+        url: Telegraph link to download.
+        metadata: (Optional) Parsed tags for TelegraphDatabase, None if the result is not recorded.
+        state: queued, running, done or failed.
+        attempts: How many times the job has been started.
+        batch: (Optional) Id of the batch the job was queued with, see `add_batch()`.
+        result: (Optional) What the job recorded with `finish()`.
+        """
+        id: int
+        url: str
+        metadata: Optional[Dict]
+        state: str
+        attempts: int
+        time_created: float
+        time_updated: float
+        error: Optional[str] = None
+        batch: Optional[int] = None
+        result: Optional[Dict] = None
+
+    @dataclass
+    class Batch:
+        """
+        id: Primary key of the batch.
+        chat_id, message_id: Telegram message the batch came from, the summary replies to it.
+        state: open until one caller claims it with `close_batch()`, then closed.
+        """
+        id: int
+        chat_id: Optional[int]
+        message_id: Optional[int]
+        state: str
+        time_created: float
+
+    def __init__(self, path: str = '/neko/.jobs.db', max_attempts: int = 3):
+        self._max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        self._database = connect(path, check_same_thread = False)
+        self._database.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                metadata JSON,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                time_created REAL NOT NULL,
+                time_updated REAL NOT NULL,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, id);
+            CREATE TABLE IF NOT EXISTS batches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                message_id INTEGER,
+                state TEXT NOT NULL,
+                time_created REAL NOT NULL
+            );
+            """
+        )
+
+        # columns added after the first release
+        columns = {r[1] for r in self._database.execute("PRAGMA table_info(jobs)")}
+        for column, kind in [('batch', 'INTEGER'), ('result', 'JSON')]:
+            if column not in columns:
+                self._database.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self._database.execute("CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs (batch)")
+        self._database.commit()
+
+    def _row(self, row) -> Job:
+        return self.Job(
+            row[0], row[1], json.loads(row[2]) if row[2] else None, *row[3:9], json.loads(row[9]) if row[9] else None)
+
+    def _add(self, url: str, metadata: Optional[Dict]) -> int:
+        with self._lock:
+            now = time.time()
+            cursor = self._database.execute(
+                "INSERT INTO jobs (url, metadata, state, time_created, time_updated) VALUES (?, ?, ?, ?, ?)",
+                (url, json.dumps(metadata, ensure_ascii = False) if metadata is not None else None, QUEUED, now, now)
+            )
+            self._database.commit()
+            return cursor.lastrowid
+
+    def _claim(self) -> Optional[Job]:
+        with self._lock:
+            row = self._database.execute(
+                "SELECT * FROM jobs WHERE state = ? ORDER BY id LIMIT 1", (QUEUED,)).fetchone()
+            if not row:
+                return None
+
+            self._database.execute(
+                "UPDATE jobs SET state = ?, attempts = attempts + 1, time_updated = ? WHERE id = ?",
+                (RUNNING, time.time(), row[0])
+            )
+            self._database.commit()
+
+            job = self._row(row)
+            job.state, job.attempts = RUNNING, job.attempts + 1
+            return job
+
+    def _add_batch(self, items: List[Tuple[str, Optional[Dict]]], chat_id: Optional[int], message_id: Optional[int]):
+        with self._lock, self._database:
+            now = time.time()
+            batch = self._database.execute(
+                "INSERT INTO batches (chat_id, message_id, state, time_created) VALUES (?, ?, ?, ?)",
+                (chat_id, message_id, OPEN, now)
+            ).lastrowid
+            self._database.executemany(
+                "INSERT INTO jobs (url, metadata, state, time_created, time_updated, batch) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (url, json.dumps(metadata, ensure_ascii = False) if metadata is not None else None,
+                     QUEUED, now, now, batch)
+                    for url, metadata in items
+                ]
+            )
+            return batch
+
+    def _close_batch(self, batch: int) -> Optional[Tuple[Batch, List[Job]]]:
+        with self._lock, self._database:
+            cursor = self._database.execute(
+                """
+                UPDATE batches SET state = ? WHERE id = ? AND state = ? AND NOT EXISTS (
+                    SELECT 1 FROM jobs WHERE batch = ? AND state IN (?, ?)
+                )
+                """,
+                (CLOSED, batch, OPEN, batch, QUEUED, RUNNING)
+            )
+            if not cursor.rowcount:
+                return None
+
+            row = self._database.execute("SELECT * FROM batches WHERE id = ?", (batch,)).fetchone()
+            jobs = self._database.execute("SELECT * FROM jobs WHERE batch = ? ORDER BY id", (batch,)).fetchall()
+
+        return self.Batch(*row), [self._row(r) for r in jobs]
+
+    def _finished_batches(self) -> List[int]:
+        with self._lock:
+            rows = self._database.execute(
+                """
+                SELECT id FROM batches WHERE state = ? AND NOT EXISTS (
+                    SELECT 1 FROM jobs WHERE batch = batches.id AND state IN (?, ?)
+                ) ORDER BY id
+                """,
+                (OPEN, QUEUED, RUNNING)
+            ).fetchall()
+
+        return [r[0] for r in rows]
+
+    def _set(self, job_id: int, state: str, error: Optional[str] = None, result: Optional[Dict] = None):
+        with self._lock:
+            self._database.execute(
+                "UPDATE jobs SET state = ?, error = ?, result = ?, time_updated = ? WHERE id = ?",
+                (state, error, json.dumps(result, ensure_ascii = False) if result is not None else None,
+                 time.time(), job_id)
+            )
+            self._database.commit()
+
+    def _recover(self) -> int:
+        with self._lock:
+            cursor = self._database.execute(
+                "UPDATE jobs SET state = ?, time_updated = ? WHERE state = ?", (QUEUED, time.time(), RUNNING))
+            self._database.commit()
+            return cursor.rowcount
+
+    def _count(self, state: str) -> int:
+        with self._lock:
+            return self._database.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (state,)).fetchone()[0]
+
+    def _list(self, state: str) -> List[Job]:
+        with self._lock:
+            rows = self._database.execute("SELECT * FROM jobs WHERE state = ? ORDER BY id", (state,)).fetchall()
+
+        return [self._row(r) for r in rows]
+
+    async def add(self, url: str, metadata: Optional[Dict] = None) -> int:
+        """Queue a job and return its id"""
+        return await asyncio.to_thread(self._add, url, metadata)
+
+    async def claim(self) -> Optional[Job]:
+        """Mark the oldest queued job as running and return it, None if the queue is empty"""
+        return await asyncio.to_thread(self._claim)
+
+    async def add_batch(
+            self,
+            items: List[Tuple[str, Optional[Dict]]],
+            chat_id: Optional[int] = None,
+            message_id: Optional[int] = None
+    ) -> int:
+        """Queue (url, metadata) pairs as one batch in a single transaction and return the batch id"""
+        return await asyncio.to_thread(self._add_batch, items, chat_id, message_id)
+
+    async def close_batch(self, batch: int) -> Optional[Tuple[Batch, List[Job]]]:
+        """
+        Close a batch once none of its jobs is queued or running.
+
+        Returns:
+            the batch and all its jobs for the one caller that closed it, None if jobs are left or it is closed
+        """
+        return await asyncio.to_thread(self._close_batch, batch)
+
+    async def finished_batches(self) -> List[int]:
+        """Ids of open batches none of whose jobs is queued or running, left by a process stopped before closing them"""
+        return await asyncio.to_thread(self._finished_batches)
+
+    async def finish(self, job_id: int, result: Optional[Dict] = None):
+        await asyncio.to_thread(self._set, job_id, DONE, None, result)
+
+    async def fail(self, job: Job, error: str):
+        """Queue the job again, or mark it failed once it has used up its attempts"""
+        state = FAILED if job.attempts >= self._max_attempts else QUEUED
+        await asyncio.to_thread(self._set, job.id, state, error)
+
+    async def recover(self) -> int:
+        """Queue jobs left running by a previous process again, call it once on startup"""
+        count = await asyncio.to_thread(self._recover)
+        if count:
+            logger.info(f"[JobStore]: Re-queued {count} interrupted jobs")
+
+        return count
+
+    async def count(self, state: str = QUEUED) -> int:
+        return await asyncio.to_thread(self._count, state)
+
+    async def list(self, state: str = QUEUED) -> List[Job]:
+        return await asyncio.to_thread(self._list, state)
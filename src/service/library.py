@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import os
+import posixpath
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from xml.etree import ElementTree
+from zipfile import BadZipFile, ZipFile
+
+from src.utils import logger
+from .telegraph import TelegraphDatabase
+
+_IMAGE = re.compile(r'\.(jpe?g|png|gif|webp|avif|bmp)$', re.IGNORECASE)
+_ARCHIVE = re.compile(r'\.(zip|cbz|epub)$', re.IGNORECASE)
+
+
+def _natural(name: str) -> List:
+    return [int(p) if p.isdigit() else p.lower() for p in re.split(r'(\d+)', name)]
+
+
+def _local(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+@dataclass
+class Archive:
+    """
+    path: Absolute path of the archive.
+    size, mtime: Checkpoint of the file, it is read again only when one of them changes.
+    pages: Number of images.
+    cover_sha256: (Optional) Hash of the cover image.
+    comic_info: Fields of ComicInfo.xml for zip archives, or of the OPF metadata for epub.
+    """
+    path: str
+    size: int
+    mtime: float
+    pages: int = 0
+    cover_sha256: Optional[str] = None
+    comic_info: Dict[str, str] = field(default_factory = dict)
+
+
+def read_zip(archive: Archive):
+    with ZipFile(archive.path) as z:
+        images = sorted((n for n in z.namelist() if _IMAGE.search(n)), key = _natural)
+        archive.pages = len(images)
+        archive.cover_sha256 = hashlib.sha256(z.read(images[0])).hexdigest() if images else None
+
+        info = next((n for n in z.namelist() if posixpath.basename(n).lower() == 'comicinfo.xml'), None)
+        if info:
+            archive.comic_info = {
+                _local(e.tag): e.text.strip() for e in ElementTree.fromstring(z.read(info)) if e.text and e.text.strip()
+            }
+
+
+def read_epub(archive: Archive):
+    with ZipFile(archive.path) as z:
+        container = ElementTree.fromstring(z.read('META-INF/container.xml'))
+        # StopIteration must not escape, a future run in an executor cannot hold it
+        opf_path = next((e.get('full-path') for e in container.iter() if _local(e.tag) == 'rootfile'), None)
+        if not opf_path:
+            raise ValueError("container.xml has no rootfile")
+        opf = ElementTree.fromstring(z.read(opf_path))
+
+        metadata = next((e for e in opf if _local(e.tag) == 'metadata'), None)
+        if metadata is None:
+            raise ValueError(f"{opf_path} has no metadata")
+        info: Dict[str, str] = {}
+        for e in metadata:
+            if e.text and e.text.strip() and _local(e.tag) != 'meta':
+                key = _local(e.tag)
+                info[key] = f"{info[key]}, {e.text.strip()}" if key in info else e.text.strip()
+        cover_id = next((e.get('content') for e in metadata if e.get('name') == 'cover'), None)
+
+        items = [e for e in opf.iter() if _local(e.tag) == 'item' and (e.get('media-type') or '').startswith('image/')]
+        cover = next(
+            (i for i in items if 'cover-image' in (i.get('properties') or '') or i.get('id') == cover_id),
+            items[0] if items else None
+        )
+
+        archive.pages = len([i for i in items if i is not cover]) or len(items)
+        archive.comic_info = info
+        if cover is not None:
+            href = posixpath.normpath(posixpath.join(posixpath.dirname(opf_path), cover.get('href')))
+            archive.cover_sha256 = hashlib.sha256(z.read(href)).hexdigest()
+
+
+def read_archive(archive: Archive) -> Archive:
+    """Fill page count, cover hash and metadata of an archive, blocking"""
+    read_epub(archive) if archive.path.lower().endswith('.epub') else read_zip(archive)
+    return archive
+
+
+class LibraryIndexer:
+    """
+    Add archives already in the library folders to TelegraphDatabase.
+
+    Every scan lists the folders, then reads only archives whose size or mtime differ from the checkpoint of the
+    previous scan. Archives are read on a thread pool and recorded in batches, each batch in one transaction.
+    """
+
+    def __init__(
+            self,
+            database: TelegraphDatabase,
+            roots: Optional[List[str]] = None,
+            workers: int = 4,
+            batch: int = 200
+    ):
+        self._database = database
+        self._roots = roots or ['/neko/komga', '/neko/epub']
+        self._workers = workers
+        self._batch = batch
+        self._lock = asyncio.Lock()
+        # checkpoints of unreadable archives, tried again once they change
+        self._failed: Dict[str, Tuple[int, float]] = {}
+
+    def _list(self) -> Dict[str, Tuple[int, float]]:
+        files = {}
+        for root in self._roots:
+            for path, _, names in os.walk(root):
+                for name in names:
+                    if not _ARCHIVE.search(name):
+                        continue
+
+                    file = os.path.abspath(os.path.join(path, name))
+                    try:
+                        stat = os.stat(file)
+                    except FileNotFoundError:
+                        continue
+                    files[file] = (stat.st_size, stat.st_mtime)
+
+        return files
+
+    def _gallery(self, archive: Archive) -> TelegraphDatabase.TelegraphData:
+        """Title and tags of an archive, from its metadata or else from its path '{root}/{artist}/{title}.zip'"""
+        info = archive.comic_info
+        stem = os.path.splitext(os.path.basename(archive.path))[0]
+        title = info.get('Title') or info.get('title') or stem
+        parent = os.path.basename(os.path.dirname(archive.path))
+        folder_artist = parent if os.path.dirname(archive.path) not in self._roots and parent != stem else None
+
+        def split(*keys: str) -> Optional[List[str]]:
+            values = [v.strip() for k in keys if info.get(k) for v in re.split(r'[,;]', info[k]) if v.strip()]
+            return list(dict.fromkeys(values)) or None
+
+        return self._database.new({
+            'title': title,
+            'file_location': archive.path,
+            'preview_url': info.get('Web'),
+            'language': split('LanguageISO', 'language'),
+            'artist': split('Writer', 'Penciller', 'creator') or ([folder_artist] if folder_artist else None),
+            'team': split('Teams', 'Imprint', 'publisher'),
+            'original': split('Series'),
+            'characters': split('Characters'),
+            'others': split('Tags', 'Genre', 'subject')
+        })
+
+    async def scan(self) -> Dict[str, int]:
+        """
+        Index new and changed archives, forget the ones that are gone.
+
+        Returns:
+            number of archives seen, indexed, unchanged, removed and failed
+        """
+        async with self._lock:
+            start = time.monotonic()
+            files = await asyncio.to_thread(self._list)
+            checkpoints = await self._database.library_checkpoints()
+
+            self._failed = {p: stat for p, stat in self._failed.items() if files.get(p) == stat}
+            changed = [
+                Archive(p, *stat) for p, stat in files.items() if checkpoints.get(p) != stat and p not in self._failed
+            ]
+            gone = [p for p in checkpoints if p not in files]
+            stats = {'seen': len(files), 'indexed': 0, 'unchanged': len(files) - len(changed), 'removed': 0,
+                     'failed': 0}
+
+            loop = asyncio.get_running_loop()
+            with ThreadPoolExecutor(self._workers, thread_name_prefix = 'library') as pool:
+                for offset in range(0, len(changed), self._batch):
+                    results = await asyncio.gather(
+                        *[loop.run_in_executor(pool, read_archive, a) for a in changed[offset:offset + self._batch]],
+                        return_exceptions = True
+                    )
+
+                    archives = []
+                    for archive, result in zip(changed[offset:offset + self._batch], results):
+                        if isinstance(result, (OSError, BadZipFile, ElementTree.ParseError, KeyError, ValueError)):
+                            logger.warning(f"[Library]: Failed to read '{archive.path}': {result}")
+                            self._failed[archive.path] = (archive.size, archive.mtime)
+                            stats['failed'] += 1
+                        elif isinstance(result, BaseException):
+                            raise result
+                        else:
+                            archives.append((self._gallery(result), result))
+
+                    if archives:
+                        await self._database.index_archives(archives)
+                        stats['indexed'] += len(archives)
+
+            if gone:
+                stats['removed'] = await self._database.forget_archives(gone)
+
+            logger.info(f"[Library]: Scanned in {round(time.monotonic() - start, 2)} seconds: {stats}")
+            return stats
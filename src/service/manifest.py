@@ -0,0 +1,102 @@
+import asyncio
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional
+
+from src.utils import logger
+
+PENDING, DONE, FAILED = 'pending', 'done', 'failed'
+
+
+class Manifest:
+    """
+    JSON sidecar of a Telegraph download job, one entry for each image:
+    {"index": {"url": str, "size": int | None, "sha256": str | None, "status": "pending" | "done" | "failed"}}
+
+    Finished and failed images are written to disk in batches of `every`, off the event loop, the rest on `save(True)`.
+    """
+
+    def __init__(self, path: str, every: int = 20):
+        self._path = path
+        self._every = every
+        self._changes = 0
+        self._lock = asyncio.Lock()
+        self._entries: Dict[str, Dict] = {}
+
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding = 'utf-8') as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"[Manifest]: Discard unreadable manifest '{path}': {e}")
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def digest(path: str) -> str:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                h.update(chunk)
+
+        return h.hexdigest()
+
+    def add(self, index: int, url: str):
+        """Register an image, the entry is reset if the same index used to point to another url"""
+        entry = self._entries.get(str(index))
+        if not entry or entry['url'] != url:
+            self._entries[str(index)] = {'url': url, 'size': None, 'sha256': None, 'status': PENDING}
+
+    def get(self, index: int) -> Optional[Dict]:
+        return self._entries.get(str(index))
+
+    def verify(self, index: int, path: str) -> bool:
+        """Check a finished image on disk against its recorded size and hash, reset the entry if it is corrupt"""
+        entry = self._entries.get(str(index))
+        if not entry or entry['status'] != DONE:
+            return False
+
+        if os.path.exists(path) and os.path.getsize(path) == entry['size'] and self.digest(path) == entry['sha256']:
+            return True
+
+        logger.warning(f"[Manifest]: '{path}' is missing or corrupt, download it again")
+        entry.update(size = None, sha256 = None, status = PENDING)
+        return False
+
+    def complete(self, index: int, size: int, sha256: str):
+        self._entries[str(index)].update(size = size, sha256 = sha256, status = DONE)
+        self._changes += 1
+
+    def fail(self, index: int):
+        self._entries[str(index)]['status'] = FAILED
+        self._changes += 1
+
+    def missing(self, total: int) -> List[int]:
+        """Indexes in range(total) that are not finished yet"""
+        return [i for i in range(total) if (self._entries.get(str(i)) or {}).get('status') != DONE]
+
+    def _write(self, raw: str):
+        tmp = f"{self._path}.part"
+        with open(tmp, 'w', encoding = 'utf-8') as f:
+            f.write(raw)
+
+        os.replace(tmp, self._path)
+
+    async def save(self, force: bool = False):
+        """Write the manifest once `every` images changed since the last write, or on any change if `force`"""
+        if not self._changes or (not force and self._changes < self._every):
+            return
+
+        async with self._lock:
+            if not self._changes:
+                return
+
+            changes, self._changes = self._changes, 0
+            try:
+                await asyncio.to_thread(self._write, json.dumps(self._entries))
+            except OSError as e:
+                # only resuming gets worse, these images are downloaded again next time
+                self._changes += changes
+                logger.warning(f"[Manifest]: Failed to save '{self._path}': {e}")
@@ -0,0 +1,211 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Optional, List
+from xml.sax.saxutils import escape, quoteattr
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+from src.utils import logger
+
+# magic numbers of image formats that are already compressed, deflating them again only costs cpu
+_COMPRESSED_MAGIC = {
+    b'\xff\xd8\xff': 'image/jpeg',
+    b'\x89PNG': 'image/png',
+    b'GIF8': 'image/gif',
+    b'RIFF': 'image/webp',
+    b'\x00\x00\x00\x1cftyp': 'image/avif',
+    b'\x00\x00\x00\x20ftyp': 'image/avif',
+}
+
+
+def media_type(path: str) -> Optional[str]:
+    """Media type of a compressed image format, None for anything else"""
+    with open(path, 'rb') as f:
+        head = f.read(12)
+
+    return next((t for magic, t in _COMPRESSED_MAGIC.items() if head.startswith(magic)), None)
+
+
+def is_compressed(path: str) -> bool:
+    return media_type(path) is not None
+
+
+class ZipPacker:
+    """
+    Append images to a zip archive while they are still downloading.
+
+    Entries are written in the order they finish into '{path}.part', the central directory is sorted by page
+    index on `close()` and the archive is renamed to `path`, so a half-written archive never looks complete.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._part = f"{path}.part"
+        self._zip: Optional[ZipFile] = None
+        self._lock = asyncio.Lock()
+
+    def _write(self, index: int, file: str):
+        if not self._zip:
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            self._zip = ZipFile(self._part, 'w')
+
+        name = f"{index}.jpg"
+        if name in self._zip.NameToInfo:
+            return
+
+        self._zip.write(file, name, ZIP_STORED if is_compressed(file) else ZIP_DEFLATED)
+
+    def _close(self):
+        self._zip.filelist.sort(key = lambda info: int(info.filename.split('.')[0]))
+        self._zip.close()
+        os.replace(self._part, self.path)
+
+    async def add(self, index: int, file: str):
+        """Append page `index` to the archive, calls are serialized and run off the event loop"""
+        async with self._lock:
+            await asyncio.to_thread(self._write, index, file)
+
+    async def close(self):
+        async with self._lock:
+            if not self._zip:
+                raise ValueError(f"Nothing packed into '{self.path}'")
+
+            await asyncio.to_thread(self._close)
+            logger.debug(f"[ZipPacker]: Create ZIP file at '{self.path}'")
+
+    async def abort(self):
+        """Drop the unfinished archive"""
+        async with self._lock:
+            if self._zip:
+                self._zip.close()
+                self._zip = None
+
+            if os.path.exists(self._part):
+                os.remove(self._part)
+
+
+class EpubWriter:
+    """
+    Write a picture book EPUB straight into a zip container, one image at a time.
+
+    The layout follows what ebooklib produced before: cover image and page, one XHTML page for each image,
+    spine in page order, NCX and nav TOC. Nothing but the current image chunk is held in memory.
+    """
+
+    _XHTML = (
+        "<?xml version='1.0' encoding='utf-8'?>\n<!DOCTYPE html>\n"
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" '
+        'lang="{lang}" xml:lang="{lang}">\n'
+        '  <head>\n    <title>{title}</title>\n  </head>\n'
+        '  <body>\n{body}\n  </body>\n</html>\n'
+    )
+
+    def __init__(self, path: str, title: str, author: str, language: str = 'en'):
+        self.path = path
+        self._title = escape(title)
+        self._author = escape(author)
+        self._lang = language
+        self._uid = str(uuid.uuid4())
+
+    def _page(self, title: str, body: str) -> str:
+        return self._XHTML.format(lang = self._lang, title = escape(title), body = body)
+
+    def _opf(self, items: List[str], spine: List[str]) -> str:
+        modified = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        return (
+            "<?xml version='1.0' encoding='utf-8'?>\n"
+            '<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="id" version="3.0">\n'
+            '  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">\n'
+            f'    <meta property="dcterms:modified">{modified}</meta>\n'
+            f'    <dc:identifier id="id">{self._uid}</dc:identifier>\n'
+            f'    <dc:title>{self._title}</dc:title>\n'
+            f'    <dc:language>{self._lang}</dc:language>\n'
+            f'    <dc:creator id="creator">{self._author}</dc:creator>\n'
+            '    <meta name="cover" content="cover-img"/>\n'
+            '  </metadata>\n'
+            '  <manifest>\n' + ''.join(f'    {i}\n' for i in items) + '  </manifest>\n'
+            '  <spine toc="ncx">\n' + ''.join(f'    <itemref idref="{i}"/>\n' for i in spine) + '  </spine>\n'
+            '</package>\n'
+        )
+
+    def _ncx(self, pages: int) -> str:
+        points = ''.join(
+            f'    <navPoint id="page_{n}" playOrder="{n}">\n'
+            f'      <navLabel>\n        <text>Page {n}</text>\n      </navLabel>\n'
+            f'      <content src="image_{n}.xhtml"/>\n'
+            '    </navPoint>\n'
+            for n in range(1, pages + 1)
+        )
+        return (
+            "<?xml version='1.0' encoding='utf-8'?>\n"
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+            f'  <head>\n    <meta content="{self._uid}" name="dtb:uid"/>\n  </head>\n'
+            f'  <docTitle>\n    <text>{self._title}</text>\n  </docTitle>\n'
+            f'  <navMap>\n{points}  </navMap>\n</ncx>\n'
+        )
+
+    def _nav(self, pages: int) -> str:
+        links = ''.join(f'        <li><a href="image_{n}.xhtml">Page {n}</a></li>\n' for n in range(1, pages + 1))
+        body = (
+            '    <nav epub:type="toc" id="id" role="doc-toc">\n'
+            f'      <h2>{self._title}</h2>\n      <ol>\n{links}      </ol>\n    </nav>'
+        )
+        return self._XHTML.format(lang = self._lang, title = self._title, body = body)
+
+    def write(self, images: List[str]):
+        """Pack `images` in the given order, blocking, run it in a worker thread"""
+        if not images:
+            raise ValueError(f"No images to pack into '{self.path}'")
+
+        os.makedirs(os.path.dirname(self.path), exist_ok = True)
+        part = f"{self.path}.part"
+
+        try:
+            with ZipFile(part, 'w', ZIP_DEFLATED) as z:
+                z.writestr('mimetype', 'application/epub+zip', ZIP_STORED)
+                z.writestr(
+                    'META-INF/container.xml',
+                    '<?xml version="1.0" encoding="utf-8"?>\n'
+                    '<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">\n'
+                    '  <rootfiles>\n'
+                    '    <rootfile media-type="application/oebps-package+xml" full-path="EPUB/content.opf"/>\n'
+                    '  </rootfiles>\n</container>\n'
+                )
+
+                cover_type = media_type(images[0])
+                cover_mime = cover_type or 'image/jpeg'
+                z.write(images[0], 'EPUB/cover.jpg', ZIP_STORED if cover_type else ZIP_DEFLATED)
+                z.writestr('EPUB/cover.xhtml', self._page('Cover', '    <img src="cover.jpg" alt="Cover"/>'))
+                items = [
+                    f'<item href="cover.jpg" id="cover-img" media-type="{cover_mime}" properties="cover-image"/>',
+                    '<item href="cover.xhtml" id="cover" media-type="application/xhtml+xml"/>'
+                ]
+                spine = []
+
+                for n, image in enumerate(images, 1):
+                    name = os.path.basename(image)
+                    image_type = media_type(image)
+                    z.write(image, f'EPUB/{name}', ZIP_STORED if image_type else ZIP_DEFLATED)
+                    z.writestr(f'EPUB/image_{n}.xhtml', self._page(f'Page {n}', f'    <img src={quoteattr(name)}/>'))
+                    items += [
+                        f'<item href={quoteattr(name)} id="img_{n}" media-type="{image_type or "image/jpeg"}"/>',
+                        f'<item href="image_{n}.xhtml" id="chapter_{n - 1}" media-type="application/xhtml+xml"/>'
+                    ]
+                    spine.append(f'chapter_{n - 1}')
+
+                items += [
+                    '<item href="nav.xhtml" id="nav" media-type="application/xhtml+xml" properties="nav"/>',
+                    '<item href="toc.ncx" id="ncx" media-type="application/x-dtbncx+xml"/>'
+                ]
+                z.writestr('EPUB/nav.xhtml', self._nav(len(images)))
+                z.writestr('EPUB/toc.ncx', self._ncx(len(images)))
+                z.writestr('EPUB/content.opf', self._opf(items, spine))
+
+            os.replace(part, self.path)
+        except BaseException:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+
+        logger.debug(f"[EpubWriter]: Create EPUB file at '{self.path}'")
@@ -1,12 +1,61 @@
 import asyncio
-from typing import Dict, Optional, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from io import BytesIO
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, List, Tuple
 
+from PIL import Image
 from PicImageSearch import Ascii2D, Iqdb, Google
 from PicImageSearch import Network
 from PicImageSearch.model import Ascii2DResponse, IqdbResponse, GoogleResponse
 from fake_useragent import UserAgent
 from httpx import Proxy
-from httpx import URL, AsyncClient
+from httpx import URL
+
+from src.utils import logger, get_client, metrics
+from .search_cache import SearchCache, image_hash
+
+
+# longest side and size in bytes uploaded to each engine, they match on much smaller thumbnails than that
+UPLOAD_LIMITS: Dict[str, Tuple[int, int]] = {
+    'ascii2d': (1200, 5 * 1024 * 1024),
+    'iqdb': (1000, 8 * 1024 * 1024),
+    'google': (1600, 10 * 1024 * 1024),
+}
+# Pillow releases the GIL while it resizes and encodes, so a few threads keep up with the bot
+_normalize_pool = ThreadPoolExecutor(2, thread_name_prefix = 'normalize')
+
+
+def normalize_image(media: bytes, max_side: int, max_bytes: int) -> bytes:
+    """
+    Downsize an image to `max_side` and re-encode it as JPEG under `max_bytes`, blocking.
+    Images already within both limits in JPEG or WebP are returned as they are.
+
+    Raises:
+        UnidentifiedImageError: 不是图像
+    """
+    with Image.open(BytesIO(media)) as image:
+        if max(image.size) <= max_side and len(media) <= max_bytes and image.format in ('JPEG', 'WEBP'):
+            return media
+
+        image.seek(0)
+        image.draft('RGB', (max_side, max_side))
+        frame = image.convert('RGBA') if 'A' in image.getbands() or 'transparency' in image.info else image.convert('RGB')
+        frame.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+    if frame.mode == 'RGBA':
+        # transparent areas turn white, as the engines show them
+        background = Image.new('RGB', frame.size, (255, 255, 255))
+        background.paste(frame, mask = frame.getchannel('A'))
+        frame = background
+
+    for quality in (90, 80, 70, 60):
+        output = BytesIO()
+        frame.save(output, 'JPEG', quality = quality, optimize = True)
+        if output.tell() <= max_bytes:
+            break
+
+    return output.getvalue() if output.tell() < len(media) else media
 
 
 def parse_cookies(cookies_str: Optional[str] = None) -> Dict[str, str]:
@@ -21,10 +70,79 @@ def parse_cookies(cookies_str: Optional[str] = None) -> Dict[str, str]:
 
 
 class AggregationSearch:
-    def __init__(self, proxy: Optional[Proxy] = None, cf_proxy: Optional[str] = None):
+    """
+    One reverse search session of an image.
+
+    The image is downloaded once however many engines ask for it at the same time, and inside `async with` (which
+    aggregation_search() opens itself) every engine shares one PicImageSearch Network client. With `normalize` each
+    engine gets the image downsized to its UPLOAD_LIMITS, made once per limit in a worker thread.
+    """
+
+    def __init__(
+            self,
+            proxy: Optional[Proxy] = None,
+            cf_proxy: Optional[str] = None,
+            cache: Optional[SearchCache] = None,
+            media: Optional[bytes] = None,
+            normalize: bool = False
+    ):
+        """
+        Args:
+            cache: 搜索结果缓存
+            media: 已有的图像数据，提供时不再下载
+            normalize: 上传前按各引擎的限制缩小并重新编码图像
+        """
         self._proxy = proxy
         self._cf_proxy = cf_proxy
-        self._media = b''
+        self._cache = cache
+        self._media = media or b''
+        self._media_task: Optional[asyncio.Task] = None
+        self._normalize = normalize
+        self._uploads: Dict[Tuple[int, int], asyncio.Task] = {}
+        self._network: Optional[Network] = None
+        self._sessions = 0
+
+    async def __aenter__(self) -> 'AggregationSearch':
+        if not self._network:
+            self._network = Network(proxies = self._proxy)
+
+        self._sessions += 1
+        return self
+
+    async def __aexit__(self, *_):
+        self._sessions -= 1
+        if not self._sessions:
+            network, self._network = self._network, None
+            await network.close()
+
+    async def _fetch_media(self, url: str) -> bytes:
+        """The image of this session, concurrent callers wait for the same download"""
+        if not self._media:
+            if not self._media_task:
+                self._media_task = asyncio.create_task(self.get_media(url))
+
+            # shielded so an engine that gets cancelled does not cancel the download the others wait for
+            self._media = await asyncio.shield(self._media_task)
+
+        return self._media
+
+    async def _upload(self, url: str, engine: str) -> bytes:
+        """The image to send to `engine`, normalized once per distinct limit when `normalize` is set"""
+        media = await self._fetch_media(url)
+        if not self._normalize or engine not in UPLOAD_LIMITS:
+            return media
+
+        limits = UPLOAD_LIMITS[engine]
+        if limits not in self._uploads:
+            self._uploads[limits] = asyncio.ensure_future(
+                asyncio.get_running_loop().run_in_executor(_normalize_pool, normalize_image, media, *limits))
+
+        try:
+            return await asyncio.shield(self._uploads[limits])
+        except (OSError, ValueError) as exc:
+            # not something Pillow can read, the engine gets the original
+            logger.debug(f"[AggregationSearch]: Uploading '{url}' as it is: {exc}")
+            return media
 
     async def get_media(self, url: str, cookies: Optional[str] = None) -> bytes:
         _url: URL = URL(url)
@@ -33,15 +151,12 @@ class AggregationSearch:
             "Referer": f"{_url.scheme}://{_url.host}/"
         }
 
-        async with AsyncClient(
-                headers = headers,
-                cookies = parse_cookies(cookies),
-                proxies = self._proxy,
-                follow_redirects = True
-        ) as client:
-            resp = await client.get(_url)
-            resp.raise_for_status()
-            return resp.content
+        if cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in parse_cookies(cookies).items())
+
+        resp = await get_client(_url, self._proxy).get(_url, headers = headers, follow_redirects = True)
+        resp.raise_for_status()
+        return resp.content
 
     @staticmethod
     async def _format(resp: Ascii2DResponse | GoogleResponse | IqdbResponse) -> List[Dict] | Dict:
@@ -96,18 +211,18 @@ class AggregationSearch:
         else:
             raise TypeError("Unsupported response type")
 
-    async def _search(self, *args: str) -> Tuple[List[Dict], List[Dict]] | Dict:
-        async with Network(proxies = self._proxy) as client:
-            if not self._media:
-                self._media = await self.get_media(args[0])
+    async def _engine_search(self, *args: str) -> Tuple[List[Dict], List[Dict]] | Dict:
+        async with nullcontext(self._network.start()) if self._network else Network(proxies = self._proxy) as client:
+            media = await self._upload(*args)
+            metrics.SEARCH_UPLOAD_BYTES.inc(args[1], value = len(media))
 
             if args[1] == "ascii2d":
                 base_url = f'{self._cf_proxy}/https://ascii2d.net' if self._cf_proxy else 'https://ascii2d.net'
                 ascii2d = Ascii2D(base_url = base_url, client = client)
                 ascii2d_bovw = Ascii2D(base_url = base_url, bovw = True, client = client)
                 resp, resp_bovw = await asyncio.gather(
-                    ascii2d.search(file = self._media),
-                    ascii2d_bovw.search(file = self._media)
+                    ascii2d.search(file = media),
+                    ascii2d_bovw.search(file = media)
                 )
                 if not resp.raw and not resp_bovw.raw:
                     raise ValueError(f"No Ascii2D search result for '{args[0]}'")
@@ -120,14 +235,14 @@ class AggregationSearch:
                 base_url = f'{self._cf_proxy}/https://iqdb.org' if self._cf_proxy else 'https://iqdb.org'
                 base_url_3d = f'{self._cf_proxy}/https://3d.iqdb.org' if self._cf_proxy else 'https://3d.iqdb.org'
                 iqdb = Iqdb(base_url = base_url, base_url_3d = base_url_3d, client = client)
-                resp = await iqdb.search(file = self._media)
+                resp = await iqdb.search(file = media)
                 if not resp.raw:
                     raise ValueError(f"No Iqdb search result for '{args[0]}'")
 
                 return await self._format(resp)
             elif args[1] == "google":
                 google = Google(client = client)
-                resp = await google.search(file = self._media)
+                resp = await google.search(file = media)
                 if not resp.raw:
                     raise ValueError(f"No Google search result for '{args[0]}'")
 
@@ -135,6 +250,25 @@ class AggregationSearch:
             else:
                 raise ValueError(f"Unrecognized argument: '{args[1]}'")
 
+    async def _search(self, *args: str) -> Tuple[List[Dict], List[Dict]] | Dict:
+        result = 'error'
+
+        try:
+            with metrics.SEARCH_SECONDS.time(args[1]):
+                response = await self._engine_search(*args)
+
+            result = 'success'
+            return response
+        except ValueError:
+            result = 'empty'
+            raise
+        except asyncio.CancelledError:
+            # dropped at its deadline
+            result = 'cancelled'
+            raise
+        finally:
+            metrics.SEARCH_RESULTS.inc(args[1], result)
+
     async def iqdb_search(self, url: str) -> Dict:
         """
         通过 Iqdb 搜索
@@ -192,19 +326,89 @@ class AggregationSearch:
         """
         return await self._search(url, 'google')
 
-    async def aggregation_search(self, url: str) -> List[Dict]:
+    async def progressive_search(
+            self,
+            url: str,
+            media: Optional[bytes] = None,
+            deadline: Optional[float] = None
+    ) -> AsyncIterator[Tuple[List[Dict], int]]:
+        """
+        聚合搜索，每个引擎返回结果时立即产出，不必等待最慢的引擎
+
+        Args:
+            url: 图像链接
+            media: 已有的图像数据，提供时不再下载
+            deadline: 单个引擎的超时秒数，超时的引擎被放弃，None 为不限
+
+        Returns:
+            (目前为止的全部结果, 尚未返回的引擎数)，最后一次产出的引擎数为 0，有缓存时只产出一次
+        """
+        self._media = media or self._media
+        key = None
+        if self._cache:
+            try:
+                key = await asyncio.to_thread(image_hash, await self._fetch_media(url))
+            except Exception as exc:
+                # searched without the cache, the engines report a failed download themselves
+                logger.debug(f"[AggregationSearch]: No image hash for '{url}': {exc}")
+
+            if key is not None and (cached := await self._cache.get(key)) is not None:
+                yield cached, 0
+                return
+
+        complete = True
+
+        async def run(engine: Callable[[str], Awaitable[Dict]]) -> Optional[Dict]:
+            nonlocal complete
+            try:
+                return await asyncio.wait_for(engine(url), deadline)
+            except ValueError as exc:
+                # an empty result is an answer too
+                logger.debug(f"[AggregationSearch]: {engine.__name__} found nothing: {exc}")
+            except asyncio.TimeoutError:
+                complete = False
+                logger.info(f"[AggregationSearch]: Dropped {engine.__name__}, no result in {deadline}s")
+            except Exception as exc:
+                complete = False
+                logger.debug(f"[AggregationSearch]: {engine.__name__} failed: {exc}")
+
+        results = []
+        async with self:
+            tasks = [asyncio.create_task(run(e)) for e in (self.ascii2d_search, self.iqdb_search, self.google_search)]
+            try:
+                for pending, task in enumerate(asyncio.as_completed(tasks), 1):
+                    result = await task
+                    if result is not None:
+                        results.append(result)
+                    if result is not None or pending == len(tasks):
+                        yield list(results), len(tasks) - pending
+            finally:
+                # the caller stopped early
+                [t.cancel() for t in tasks]
+
+        # results missing an engine that was slow or down this time are not kept for the whole ttl
+        if key is not None and results and complete:
+            await self._cache.put(key, results)
+
+    async def aggregation_search(
+            self,
+            url: str,
+            media: Optional[bytes] = None,
+            deadline: Optional[float] = None
+    ) -> List[Dict]:
         """
         聚合搜索
 
         Args:
             url: 图像链接
+            media: 已有的图像数据，提供时不再下载
+            deadline: 单个引擎的超时秒数，超时的引擎被放弃，None 为不限
 
         Returns:
-            列表形式的搜索结果，注意可能为空
+            列表形式的搜索结果，按引擎返回的先后排列，注意可能为空，有缓存时相同或相似图像直接返回缓存结果
         """
-        return [r for r in await asyncio.gather(
-            self.ascii2d_search(url),
-            self.iqdb_search(url),
-            self.google_search(url),
-            return_exceptions = True
-        ) if r is not None and not isinstance(r, Exception)]
+        results = []
+        async for results, _ in self.progressive_search(url, media, deadline):
+            pass
+
+        return results
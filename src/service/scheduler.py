@@ -0,0 +1,84 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Coroutine, Set
+
+
+class JobScheduler:
+    """
+    Run jobs with a global concurrency limit and a per image host limit.
+
+    A job holds a global slot from `acquire()` until it finishes. Once its image host is known it enters
+    `host()`. If that host is already saturated, the job gives its global slot back while it waits, so jobs for
+    other hosts can keep running. At most `concurrency` jobs wait like that, the others keep their slot while they
+    wait, so a queue of links to one host is not claimed all at once.
+    """
+
+    def __init__(self, concurrency: int = 2, per_host: int = 2):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self._slots = asyncio.Semaphore(concurrency)
+        self._parking = asyncio.Semaphore(concurrency)
+        self._parked: Set[int] = set()
+        self._hosts: Dict[str, asyncio.Semaphore] = {}
+        self._running: Dict[int, Dict[str, Optional[str]]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def acquire(self):
+        """Wait for a free global slot, pass it to `start()` or give it back with `release()`"""
+        await self._slots.acquire()
+
+    def release(self):
+        self._slots.release()
+
+    def start(self, job_id: int, url: str, coro: Coroutine) -> asyncio.Task:
+        """Run a job in the slot taken by `acquire()`, the slot is released when the job ends"""
+
+        def done(t: asyncio.Task):
+            self._tasks.discard(t)
+            self._running.pop(job_id, None)
+            self._parked.discard(job_id)
+            self._slots.release()
+
+        self._running[job_id] = {'url': url, 'host': None}
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(done)
+        return task
+
+    @asynccontextmanager
+    async def host(self, job_id: int, host: str):
+        limit = self._hosts.setdefault(host, asyncio.Semaphore(self.per_host))
+
+        if limit.locked() and not self._parking.locked():
+            await self._parking.acquire()
+            self._parked.add(job_id)
+            self._slots.release()
+            try:
+                await limit.acquire()
+            finally:
+                self._parked.discard(job_id)
+                self._parking.release()
+                await self._slots.acquire()
+        else:
+            await limit.acquire()
+
+        self._running[job_id]['host'] = host
+        try:
+            yield
+        finally:
+            limit.release()
+
+    def status(self) -> Dict:
+        """Running jobs, jobs parked without a slot until their host is free, and how many jobs each host is serving"""
+        hosts: Dict[str, int] = {}
+        for job in self._running.values():
+            if job['host']:
+                hosts[job['host']] = hosts.get(job['host'], 0) + 1
+
+        return {
+            'concurrency': self.concurrency,
+            'per_host': self.per_host,
+            'running': {job_id: dict(job) for job_id, job in self._running.items() if job_id not in self._parked},
+            'parked': {job_id: dict(job) for job_id, job in self._running.items() if job_id in self._parked},
+            'hosts': hosts
+        }
@@ -0,0 +1,219 @@
+import json
+import time
+from collections import OrderedDict
+from io import BytesIO
+from sqlite3 import Connection
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from src.utils import logger, AsyncSQLite, metrics
+
+_BANDS = 4
+_MASK = (1 << 64) - 1
+
+
+def image_hash(media: bytes) -> int:
+    """
+    64-bit difference hash of an image, blocking.
+    Resized or recompressed copies of an image get the same or a close hash.
+
+    Raises:
+        UnidentifiedImageError: 不是图像
+    """
+    with Image.open(BytesIO(media)) as image:
+        pixels = list(image.convert('L').resize((9, 8), Image.Resampling.BOX).getdata())
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = value << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+
+    return value
+
+
+def _distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def _signed(value: int) -> int:
+    """sqlite integers are signed 64-bit"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _bands(value: int) -> List[int]:
+    return [value >> (16 * i) & 0xffff for i in range(_BANDS)]
+
+
+class SearchCache:
+    """
+    Results of AggregationSearch (or of any image search) keyed by the perceptual hash of the searched image.
+
+    Recent results stay in memory, all of them in sqlite until `ttl` seconds have passed. A lookup also returns results
+    of an image whose hash differs in at most `max_distance` bits. The hash is stored as four 16-bit bands, and two
+    hashes within 3 bits share at least one band, so the persistent tier only compares rows with a matching band.
+    Larger distances still work in memory but may miss rows on disk.
+
+    Results can also be stored under an alias, such as the file_unique_id of a Telegram photo, which finds them
+    before the image is downloaded.
+    """
+    _shared: Dict[str, 'SearchCache'] = {}
+
+    def __init__(
+            self,
+            path: str = '/neko/.search.db',
+            ttl: float = 7 * 86400.,
+            max_distance: int = 3,
+            capacity: int = 512
+    ):
+        self._ttl = ttl
+        self._max_distance = max_distance
+        self._capacity = capacity
+        self._memory: OrderedDict[int, Tuple[float, List[Dict]]] = OrderedDict()
+        self._aliases: OrderedDict[str, int] = OrderedDict()
+        self._db = AsyncSQLite.shared(path, self._setup)
+
+    @staticmethod
+    def _setup(connection: Connection):
+        with connection:
+            connection.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS search_cache (
+                    hash INTEGER PRIMARY KEY,
+                    {', '.join(f'band{i} INTEGER NOT NULL' for i in range(_BANDS))},
+                    results JSON NOT NULL,
+                    time_expires REAL NOT NULL
+                );
+                """
+            )
+            for i in range(_BANDS):
+                connection.execute(f"CREATE INDEX IF NOT EXISTS idx_search_cache_band{i} ON search_cache (band{i})")
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS search_alias (
+                    alias TEXT PRIMARY KEY,
+                    hash INTEGER NOT NULL
+                );
+                """
+            )
+
+    @classmethod
+    def shared(
+            cls,
+            path: str = '/neko/.search.db',
+            ttl: float = 7 * 86400.,
+            max_distance: int = 3,
+            capacity: int = 512
+    ) -> 'SearchCache':
+        """Process-wide cache for `path`, the other arguments only apply when it is created"""
+        if path not in cls._shared:
+            cls._shared[path] = cls(path, ttl, max_distance, capacity)
+
+        return cls._shared[path]
+
+    def _remember(self, key: int, expires: float, results: List[Dict], alias: Optional[str] = None):
+        self._memory[key] = (expires, results)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._capacity:
+            self._memory.popitem(last = False)
+
+        if alias:
+            self._aliases[alias] = key
+            self._aliases.move_to_end(alias)
+            while len(self._aliases) > self._capacity:
+                self._aliases.popitem(last = False)
+
+    def _from_memory(self, key: int, now: float) -> Optional[List[Dict]]:
+        if key in self._memory:
+            match = key
+        else:
+            match = min(self._memory, key = lambda k: _distance(k, key), default = None)
+            if match is None or _distance(match, key) > self._max_distance:
+                return None
+
+        expires, results = self._memory[match]
+        if expires <= now:
+            del self._memory[match]
+            return None
+
+        self._memory.move_to_end(match)
+        return results
+
+    async def get(self, key: int) -> Optional[List[Dict]]:
+        """Cached results of the image with hash `key` or of a near duplicate, None if there are none"""
+        now = time.time()
+        if (results := self._from_memory(key, now)) is not None:
+            metrics.SEARCH_CACHE.inc('memory')
+            return results
+
+        rows = await self._db.execute(
+            f"""
+            SELECT hash, results, time_expires FROM search_cache
+            WHERE ({' OR '.join(f'band{i} = ?' for i in range(_BANDS))}) AND time_expires > ?
+            """,
+            (*_bands(key), now)
+        )
+        distance, stored, raw, expires = min(
+            ((_distance(r[0] & _MASK, key), r[0] & _MASK, *r[1:]) for r in rows), default = (None,) * 4)
+        if distance is None or distance > self._max_distance:
+            metrics.SEARCH_CACHE.inc('miss')
+            return None
+
+        metrics.SEARCH_CACHE.inc('disk')
+        results = json.loads(raw)
+        self._remember(stored, expires, results)
+        return results
+
+    async def get_alias(self, alias: str) -> Optional[List[Dict]]:
+        """Cached results stored under `alias`, None if there are none"""
+        now = time.time()
+        if alias in self._aliases:
+            self._aliases.move_to_end(alias)
+            if (results := self._from_memory(self._aliases[alias], now)) is not None:
+                metrics.SEARCH_CACHE.inc('memory')
+                return results
+
+        rows = await self._db.execute(
+            """
+            SELECT search_cache.hash, results, time_expires FROM search_alias
+            JOIN search_cache ON search_cache.hash = search_alias.hash
+            WHERE alias = ? AND time_expires > ?
+            """,
+            (alias, now)
+        )
+        if not rows:
+            metrics.SEARCH_CACHE.inc('miss')
+            return None
+
+        metrics.SEARCH_CACHE.inc('disk')
+        results = json.loads(rows[0][1])
+        self._remember(rows[0][0] & _MASK, rows[0][2], results, alias)
+        return results
+
+    async def put(self, key: int, results: List[Dict], alias: Optional[str] = None):
+        """Cache the results of the image with hash `key`, also under `alias` when given"""
+        expires = time.time() + self._ttl
+        self._remember(key, expires, results, alias)
+
+        def put():
+            with self._db.connection as connection:
+                connection.execute(
+                    f"INSERT OR REPLACE INTO search_cache VALUES (?, {', '.join('?' * _BANDS)}, ?, ?)",
+                    (_signed(key), *_bands(key), json.dumps(results, ensure_ascii = False, default = str), expires)
+                )
+                if alias:
+                    connection.execute("INSERT OR REPLACE INTO search_alias VALUES (?, ?)", (alias, _signed(key)))
+
+        await self._db.run(put)
+
+    async def prune(self) -> int:
+        """Delete expired results, return how many"""
+        now = time.time()
+        for key in [k for k, (expires, _) in self._memory.items() if expires <= now]:
+            del self._memory[key]
+
+        removed = len(await self._db.execute(
+            "DELETE FROM search_cache WHERE time_expires <= ? RETURNING hash", (now,)))
+        await self._db.execute("DELETE FROM search_alias WHERE hash NOT IN (SELECT hash FROM search_cache)")
+        logger.info(f"[SearchCache]: Removed {removed} expired results")
+        return removed
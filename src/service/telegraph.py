@@ -1,24 +1,32 @@
 import asyncio
+import base64
+import hashlib
+import json
 import os
 import re
-import shutil
 import time
+from ast import literal_eval
+from contextlib import nullcontext
 from dataclasses import dataclass
-from datetime import datetime, timedelta
-from random import randint
-from sqlite3 import connect, Cursor
-from typing import Optional, List, Dict, Union, Match
+from datetime import datetime
+from random import randint, sample
+from sqlite3 import Connection, Cursor, DatabaseError
+from typing import (
+    Any, Optional, List, Dict, Union, Match, Tuple, Callable, AsyncContextManager, AsyncIterator, NamedTuple
+)
 from urllib.parse import urljoin
-from zipfile import ZipFile, ZIP_DEFLATED
 
 import aiofiles
 import httpx
 from bs4 import BeautifulSoup
-from ebooklib import epub
 from fake_useragent import UserAgent
 from httpx import URL, AsyncClient, Proxy, Response
 
-from src.utils import logger
+from src.utils import logger, get_client, get_limiter, AdaptiveLimiter, AsyncSQLite, metrics
+from .blob_store import BlobStore
+from .janitor import TempJanitor
+from .manifest import Manifest
+from .packer import ZipPacker, EpubWriter
 
 
 class Telegraph:
@@ -27,7 +35,9 @@ class Telegraph:
             telegraph_url: str,
             thread: int = 1,
             proxy: Optional[Proxy] = None,
-            cloudflare_workers_proxy: Optional[str] = None
+            cloudflare_workers_proxy: Optional[str] = None,
+            gate: Optional[Callable[[str], AsyncContextManager]] = None,
+            root: str = '/neko'
     ):
         self._urls: List[str] = [
             f'{cloudflare_workers_proxy}/{telegraph_url}' if cloudflare_workers_proxy else telegraph_url
@@ -36,9 +46,13 @@ class Telegraph:
         self._proxy: Optional[Proxy] = proxy
         self._cf_proxy: Optional[str] = cloudflare_workers_proxy
         self._thread = thread
+        # called with the image host once it is known, downloading and packing run inside the returned context
+        self._gate = gate
 
         self._headers: Dict[str, str] = {'User-Agent': UserAgent().random}
         self._images: List[Optional[str]] = []  # image urls get from article
+        self._pages: List[asyncio.Task] = []  # pending follow-up pages of a multi-part article, in page order
+        self._page_limit = 4  # follow-up pages fetched at the same time
         self._host: Optional[str] = None
 
         self._raw_title: Optional[str] = None
@@ -47,91 +61,197 @@ class Telegraph:
         self.thumbnail: Optional[str | URL] = None  # equals to self._images[0]
 
         # declared in src/utils/env.py
-        self._komga_dir = '/neko/komga'
-        self._epub_dir = '/neko/epub'
-        self._tmp_dir = '/neko/.temp'
+        self._komga_dir = os.path.join(root, 'komga')
+        self._epub_dir = os.path.join(root, 'epub')
+        self._tmp_dir = os.path.join(root, '.temp')
+        self._blob_dir = os.path.join(root, '.blob')
         self._file_dir = self._file_path = self._download_dir = self._tmp_dir
 
-        # remove cache folders last longer than 1 day
-        for root, dirs, _ in os.walk(self._tmp_dir):
-            for temp_dir in dirs:
-                path = os.path.join(root, temp_dir)
-                modified_time = datetime.fromtimestamp(os.path.getmtime(path))
-                shutil.rmtree(path) if datetime.now() - modified_time > timedelta(days = 1) else None
+        # old download dirs are cleaned by the janitor in the background, it leaves the ones of running jobs alone
+        self._janitor = TempJanitor.shared(self._tmp_dir)
+        # pages shared with galleries downloaded before are linked from here instead of fetched again
+        self._store = BlobStore.shared(self._blob_dir)
 
-    async def _task_handler(self, timeout: int) -> int:
+    def _unproxied(self, url: str) -> str:
+        """The original url of an image fetched through the Cloudflare worker proxy"""
+        return url[len(self._cf_proxy) + 1:] if self._cf_proxy and url.startswith(self._cf_proxy) else url
+
+    async def _stream_download(
+            self,
+            client: AsyncClient,
+            limiter: AdaptiveLimiter,
+            url: str,
+            path: str,
+            timeout: int
+    ) -> Tuple[int, str]:
+        """
+        Stream an image into '{path}.part' chunk by chunk, rename it to `path` once its length is verified.
+        Return size and sha256 of the file.
+        """
+        part = f"{path}.part"
+        latency = status = None
+        h = hashlib.sha256()
+
+        await limiter.acquire()
+        start = time.monotonic()
+
+        try:
+            async with client.stream('GET', url, headers = self._headers, timeout = timeout) as resp:
+                latency, status = time.monotonic() - start, resp.status_code
+                resp.raise_for_status()
+
+                written = 0
+                async with aiofiles.open(part, 'wb') as f:
+                    async for chunk in resp.aiter_bytes(64 * 1024):
+                        h.update(chunk)
+                        written += await f.write(chunk)
+
+                # content-length counts encoded bytes when the body is compressed
+                expected = resp.headers.get('Content-Length')
+                received = resp.num_bytes_downloaded if 'Content-Encoding' in resp.headers else written
+
+            if not written:
+                raise OSError(f"'{self._host}' respond no content for '{path}'")
+            if expected is not None and int(expected) != received:
+                raise OSError(f"Incomplete content for '{path}', expect {expected} bytes but got {received}")
+
+            os.replace(part, path)
+            host = URL(self._unproxied(url)).host
+            metrics.DOWNLOAD_BYTES.inc(host, value = received)
+            metrics.DOWNLOAD_SECONDS.observe(host, value = time.monotonic() - start)
+            return written, h.hexdigest()
+        except BaseException:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        finally:
+            await limiter.release(latency, status)
+
+    async def _task_handler(self, timeout: int, packer: Optional[ZipPacker] = None) -> int:
         async def download_handler():
-            async def worker(q: asyncio.Queue, client: AsyncClient):
+            async def pack(i: int, p: str):
+                nonlocal pack_error
+                try:
+                    await packer.add(i, p) if packer else None
+                except (OSError, ValueError) as _e:
+                    # the archive is broken from here on, downloading more pages won't save it
+                    logger.error(f"[Telegraph]: Failed to pack '{p}' because '{str(_e)}'")
+                    pack_error = pack_error or _e
+
+            async def worker(q: asyncio.Queue, client: AsyncClient, limiter: AdaptiveLimiter):
                 while True:
                     i, u, r = await q.get()
                     if not u:
                         q.task_done()
                         break
 
-                    p = os.path.join(self._download_dir, f"{i}.jpg")
-                    if os.path.exists(p):
-                        logger.debug(f"[Telegraph]: Skip existed '{p}'")
-                        q.task_done()
-                        continue
-
-                    try:
-                        resp = (await client.get(u, headers = self._headers, timeout = timeout)).raise_for_status()
-                        if not resp.content:
-                            raise OSError(f"'{self._host}' respond no content for '{p}'")
-                    except (httpx.HTTPError, OSError) as _e1:
-                        if r != 3:
-                            logger.warning(f"[Telegraph]: Failed to download '{p}', retry time {r + 1}")
-                            q.task_done()
-                            q.put_nowait((i, u, r + 1))
-                        else:
-                            logger.error(f"[Telegraph]: Failed to download '{p}' because '{str(_e1)}'")
-                            q.task_done()
-
-                        continue
-
                     try:
-                        async with aiofiles.open(p, 'wb') as f:
-                            await f.write(await resp.aread())
-
-                        logger.debug(f"[Telegraph]: Image download complete for '{p}'")
-                    except Exception as _e2:
-                        logger.error(f"[Telegraph]: Failed to write image '{p}': {str(_e2)}")
+                        if pack_error:
+                            continue
+
+                        p = os.path.join(self._download_dir, f"{i}.jpg")
+                        try:
+                            verified = await asyncio.to_thread(manifest.verify, i, p)
+                        except OSError as _e:
+                            logger.warning(f"[Telegraph]: Failed to verify '{p}': {_e}, download it again")
+                            verified = False
+
+                        if verified:
+                            logger.debug(f"[Telegraph]: Skip verified '{p}'")
+                            await pack(i, p)
+                            continue
+
+                        try:
+                            key = self._unproxied(u)
+                            stored = await self._store.get(key, p, self._file_path)
+
+                            if stored:
+                                manifest.complete(i, *stored)
+                                await manifest.save()
+                                logger.debug(f"[Telegraph]: Link stored image for '{p}'")
+                            else:
+                                size, sha256 = await self._stream_download(client, limiter, u, p, timeout)
+                                manifest.complete(i, size, sha256)
+                                await manifest.save()
+                                await self._store.put(key, p, size, sha256, self._file_path)
+                                logger.debug(f"[Telegraph]: Image download complete for '{p}'")
+                        except (httpx.HTTPError, OSError, DatabaseError) as _e1:
+                            if r != 3:
+                                logger.warning(f"[Telegraph]: Failed to download '{p}', retry time {r + 1}")
+                                metrics.DOWNLOAD_RETRIES.inc(self._host)
+                                q.put_nowait((i, u, r + 1))
+                            else:
+                                logger.error(f"[Telegraph]: Failed to download '{p}' because '{str(_e1)}'")
+                                manifest.fail(i)
+                                await manifest.save()
+                                metrics.DOWNLOAD_FAILURES.inc(self._host)
+
+                            continue
+
+                        await pack(i, p)
+                    finally:
+                        # every item is marked done whatever happens to it, or dq.join() never returns
+                        q.task_done()
 
-                    q.task_done()
+            async def feed(q: asyncio.Queue):
+                for num, url in enumerate(self._images):
+                    manifest.add(num, url)
+                    q.put_nowait((num, url, 0))
+
+                # follow-up pages arrive in page order, their images join the queue while workers are running
+                while self._pages:
+                    for url in await self._pages.pop(0):
+                        manifest.add(len(self._images), url)
+                        q.put_nowait((len(self._images), url, 0))
+                        self._images.append(url)
+
+                logger.debug(
+                    f"[Telegraph]: Queue Length: {len(self._images)}, Service host: {self._host}, "
+                    f"concurrency: {get_limiter(self._host).limit}"
+                )
 
+            pack_error: Optional[Exception] = None
             dq = asyncio.Queue()
-            for num, url in enumerate(self._images):
-                dq.put_nowait((num, url, 0))
-
-            logger.debug(f"[Telegraph]: Queue Length: {len(self._images)}, Service host: {self._host}")
-
-            async with httpx.AsyncClient(proxy = self._proxy) as c:
-                tasks = []
-                for _ in range(self._thread):
-                    tasks.append(asyncio.create_task(worker(dq, c)))
+            c = get_client(self._images[0], self._proxy)
+            # workers wait on the host limiter, so its maximum is the most that can ever run at once
+            lim = get_limiter(self._host, self._thread)
+            tasks = []
+            for _ in range(lim.maximum):
+                tasks.append(asyncio.create_task(worker(dq, c, lim)))
 
+            try:
+                await feed(dq)
                 await dq.join()
+            except BaseException:
+                [t.cancel() for t in tasks + self._pages]
+                raise
 
-            for _ in range(self._thread):
+            for _ in range(lim.maximum):
                 dq.put_nowait((None, None, None))
 
             await asyncio.gather(*tasks)
+            if pack_error:
+                raise pack_error
 
         async def check():
-            for root, _, files in os.walk(self._download_dir):
-                if len(files) != len(self._images):
-                    raise ValueError(f"Missing {len(self._images) - len(files)} files in '{self._download_dir}'")
-                for f in files:
-                    if os.path.getsize(os.path.join(root, f)) == 0:
-                        raise ValueError(f"'{os.path.join(root, f)}' is empty")
+            missing = manifest.missing(len(self._images))
+            if missing:
+                raise ValueError(f"Missing {len(missing)} files in '{self._download_dir}': {missing}")
 
         # execute script
         if os.path.exists(self._file_path):
             logger.debug(f"[Telegraph]: Skip existed file at '{self._file_path}'")
+            [page.cancel() for page in self._pages]
             return 1
 
         os.makedirs(self._download_dir, exist_ok = True)
-        await download_handler()
+        # resumed jobs only download images that are not recorded as finished and intact
+        manifest = Manifest(os.path.join(self._download_dir, '.manifest.json'))
+        try:
+            await download_handler()
+        finally:
+            await manifest.save(True)
+
         await check()
 
         return 0
@@ -164,28 +284,48 @@ class Telegraph:
             escaped_p = {re.escape(key): value for key, value in (pr if replace else pc).items()}
             return re.sub('|'.join(escaped_p.keys()), lambda x: escaped_p[re.escape(x.group())], raw)
 
+        def get_images(r: Response) -> List[str]:
+            return [
+                f"{self._cf_proxy}/{full_url}" if self._cf_proxy else full_url
+                for i in re.findall(r'img src="(.*?)"', r.text)
+                for full_url in [urljoin(str(r.url), i)]
+            ]
+
+        async def get_page(url: str, limit: asyncio.Semaphore) -> List[str]:
+            async with limit:
+                for attempt in range(1, 4):
+                    try:
+                        return get_images(
+                            (await client.get(url, headers = self._headers, timeout = 10)).raise_for_status())
+                    except httpx.HTTPError as _e:
+                        if attempt == 3:
+                            raise
+
+                        logger.warning(f"[Telegraph]: Failed to get page '{url}': {_e}, retry time {attempt}")
+
         async def regex(r: Response):
-            self._urls += [
+            self._urls = self._urls[:1] + [
                 f"{self._cf_proxy}/{full_url}" if self._cf_proxy else full_url
                 for i in re.findall(r'a href="(.*?)"', r.text)
                 for full_url in [urljoin(str(r.url), i)]
                 if full_url.startswith("https://telegra.ph")
             ]
-            self._images = [
-                f"{self._cf_proxy}/{full_url}" if self._cf_proxy else full_url
-                for r_ex in (
-                    [r] if len(self._urls) == 1 else
-                    [await client.get(url) for url in self._urls[1:]]
-                )
-                for i in re.findall(r'img src="(.*?)"', r_ex.text)
-                for full_url in [urljoin(str(r_ex.url), i)]
-            ]
-            self._host = URL(self._images[0]).host
-            self._raw_title = clean_symbols(BeautifulSoup(r.text, 'html.parser').find("title").text).strip()
+            [page.cancel() for page in self._pages]
+
+            if len(self._urls) == 1:
+                self._images, self._pages = get_images(r), []
+            else:
+                # fetch follow-up pages concurrently, only wait for the first one here
+                limit = asyncio.Semaphore(self._page_limit)
+                self._pages = [asyncio.create_task(get_page(url, limit)) for url in self._urls[1:]]
+                self._images = await self._pages.pop(0)
 
             if len(self._images) == 0:
                 raise ValueError(f"No images from '{self._urls}'")
 
+            # limits, the scheduler gate and metrics are per image host, not per worker proxy
+            self._host = URL(self._unproxied(self._images[0])).host
+            self._raw_title = clean_symbols(BeautifulSoup(r.text, 'html.parser').find("title").text).strip()
             self.thumbnail = self._images[0]
 
             matched_title = get_title(self._raw_title)
@@ -212,57 +352,22 @@ class Telegraph:
             self._file_path = os.path.join(self._file_dir, f"{self.title}.{'zip' if is_zip else 'epub'}")
 
         # execute script
-        async with AsyncClient(timeout = 10, proxy = self._proxy) as client:
-            await regex((await client.get(url = self._urls[0], headers = self._headers)).raise_for_status())
+        client = get_client(self._urls[0], self._proxy)
+        await regex((await client.get(url = self._urls[0], headers = self._headers, timeout = 10)).raise_for_status())
 
     async def _process_handler(self, is_zip = False, is_epub = False) -> Optional[int]:
-        async def create_zip():
-            os.mkdir(self._file_dir) if not os.path.exists(self._file_dir) else None
-
-            with ZipFile(os.path.join(self._file_dir, self.title) + '.zip', 'w', ZIP_DEFLATED) as f:
-                for root, _, files in os.walk(self._download_dir):
-                    for filename in files:
-                        file_path = os.path.join(root, filename)
-                        f.write(file_path, os.path.relpath(file_path, self._download_dir))
-
-            logger.debug(f"[Telegraph]: Create ZIP file at '{self._file_path}'")
-
         async def create_epub():
-            manga = epub.EpubBook()
-            manga.set_title(self.title)
-            manga.add_author(self.artist)
-            manga.set_language('zh') if re.search(r'翻訳|汉化|中國|翻译|中文|中国', self._raw_title) else None
-
             sorted_images = sorted(
                 [f for f in os.listdir(self._download_dir) if
                  os.path.isfile(os.path.join(self._download_dir, f)) and str(f).endswith('.jpg')],
                 key = lambda x: int(re.search(r'\d+', x).group())
             )
 
-            async with aiofiles.open(os.path.join(self._download_dir, sorted_images[0]), "rb") as f:
-                manga.set_cover("cover.jpg", await f.read())
-
-            for i, path in enumerate(sorted_images):
-                html = epub.EpubHtml(title = f"Page {i + 1}", file_name = f"image_{i + 1}.xhtml",
-                                     content = f"<html><body><img src='{path}'></body></html>".encode('utf8'))
-
-                async with aiofiles.open(os.path.join(self._download_dir, path), "rb") as f:
-                    manga.add_item(epub.EpubImage(
-                        uid = path, file_name = path, media_type = "image/jpeg", content = await f.read()))
-
-                manga.add_item(html)
-                manga.spine.append(html)
-                manga.toc.append(epub.Link(html.file_name, html.title, ''))
-
-            manga.add_item(epub.EpubNav())
-            manga.add_item(epub.EpubNcx())
-
-            back = os.getcwd()
-            os.mkdir(self._file_dir) if not os.path.exists(self._file_dir) else None
-            os.chdir(self._file_dir)
-            epub.write_epub(f"{self.title}.epub", manga, {})
-            os.chdir(back)
-            logger.debug(f"[Telegraph]: Create EPUB file at '{self._file_path}'")
+            writer = EpubWriter(
+                self._file_path, self.title, self.artist,
+                'zh' if re.search(r'翻訳|汉化|中國|翻译|中文|中国', self._raw_title) else 'en'
+            )
+            await asyncio.to_thread(writer.write, [os.path.join(self._download_dir, f) for f in sorted_images])
 
         async def fun_handler(func, *args):
             for attempt in range(1, 4):
@@ -280,7 +385,18 @@ class Telegraph:
 
         logger.info(f"[Telegraph]: Get task '{self._raw_title}'")
 
-        return_value = await self._task_handler(timeout = 3)
+        with self._janitor.active(self._download_dir):
+            async with self._gate(self._host) if self._gate else nullcontext():
+                # zip entries are appended while images land, epub is built after all pages are downloaded
+                packer = ZipPacker(self._file_path) if is_zip else None
+                try:
+                    return_value = await self._task_handler(timeout = 3, packer = packer)
+                    if return_value == 0:
+                        await packer.close() if is_zip else await create_epub()
+                except BaseException:
+                    await packer.abort() if packer else None
+                    raise
+
         if return_value == 1:
             return
         elif return_value == 2:
@@ -289,8 +405,6 @@ class Telegraph:
             except Exception as _e:
                 logger.error(f"[Telegraph]: {_e}")
                 return 1
-        else:
-            await create_zip() if is_zip else await create_epub()
 
     async def get_epub(self) -> Optional[str]:
         """Pack manga to epub format and return file path"""
@@ -304,7 +418,7 @@ class Telegraph:
     async def get_zip(self) -> Optional[str]:
         """Pack manga to zip format"""
         start = time.time()
-        if not await self._process_handler(is_zip = True):
+        if await self._process_handler(is_zip = True) == 1:
             return None
 
         logger.info(f"[Telegraph]: Task '{self._raw_title}' finished in {round(time.time() - start, 2)} seconds")
@@ -312,7 +426,10 @@ class Telegraph:
 
     async def get_info(self):
         """Gey basic info from Telegraph link"""
-        return await self._get_info_handler()
+        await self._get_info_handler()
+
+        while self._pages:
+            self._images += await self._pages.pop(0)
 
 
 class TelegraphDatabase:
@@ -364,81 +481,251 @@ class TelegraphDatabase:
                 if key in attributes:
                     setattr(self, key, value)
 
-    def __init__(self):
+    class TelegraphRow(NamedTuple):
+        """A gallery in paged results, the columns of `telegraph` followed by its tags keyed by namespace"""
+        tag_id: int
+        time_added: Optional[str]
+        title: str
+        original_url: Optional[str]
+        preview_url: Optional[str]
+        file_location: Optional[str]
+        tags: Dict[str, List[str]]
+
+    class Page(NamedTuple):
+        """One page of results, pass `cursor` back for the next one, None on the last page"""
+        rows: List['TelegraphDatabase.TelegraphRow']
+        cursor: Optional[str]
+
+    # tag namespaces, in the order of TelegraphData fields and of the old `tag` table columns
+    _namespaces = ['language', 'artist', 'team', 'original', 'characters', 'male', 'female', 'others']
+    # tag namespaces in the full-text index
+    _fts_namespaces = ['artist', 'team', 'original', 'characters']
+    _version = 3
+
+    def __init__(self, path: str = "../telegraph.db"):
         self._attrs = ['tag_id', 'time_added', 'title', 'original_url', 'preview_url',
                        'file_location', 'telegraph_id', 'lang', 'artist', 'team',
                        'original', 'characters', 'male', 'female', 'others']
 
-        if not os.path.exists("../telegraph.db"):
+        if not os.path.exists(path):
             logger.info("[TelegraphDatabase]: Initializing new database...")
-            self._database = connect("../telegraph.db")
 
-            cursor = self._database.cursor()
-            _script = [
-                """
-                CREATE TABLE telegraph (
-                    tag_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    time_added DATE,
-                    title VARCHAR(100) NOT NULL,
-                    original_url VARCHAR(200),
-                    preview_url VARCHAR(200),
-                    file_location VARCHAR(200),
-                    FOREIGN KEY (tag_id) REFERENCES tag(telegraph_id)
-                );
-                """,
-                """
-                CREATE TABLE tag (
-                    telegraph_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    lang JSON,
-                    artist JSON,
-                    team JSON,
-                    original JSON,
-                    characters JSON,
-                    male JSON,
-                    female JSON,
-                    others JSON,
-                    FOREIGN KEY (telegraph_id) REFERENCES telegraph(tag_id)
-                );
-                """,
-                """
-                CREATE INDEX idx_telegraph_tag_id ON telegraph (tag_id);
-                """,
-                """
-                CREATE INDEX idx_telegraph_name ON telegraph (title);
-                """,
-                """
-                CREATE INDEX idx_tag_telegraph_id ON tag (telegraph_id);
-                """,
-                """
-                CREATE INDEX idx_tag_language ON tag (lang);
-                """,
-                """
-                CREATE INDEX idx_tag_artist ON tag (artist);
-                """,
-                """
-                CREATE INDEX idx_tag_team ON tag (team);
-                """,
-                """
-                CREATE INDEX idx_tag_original ON tag (original);
-                """,
-                """
-                CREATE INDEX idx_tag_character ON tag (characters);
-                """,
-                """
-                CREATE INDEX idx_tag_male ON tag (male);
-                """,
-                """
-                CREATE INDEX idx_tag_female ON tag (female);
-                """,
-                """
-                CREATE INDEX idx_tag_others ON tag (others);
-                """,
-            ]
-            [cursor.execute(script) for script in _script]
+        # every instance for the same file shares one connection and its thread, which migrates before any query
+        self._db = AsyncSQLite.shared(path, self._setup)
+
+    @property
+    def _database(self) -> Connection:
+        """Connection of the database thread, only use it in functions run by `self._db`"""
+        return self._db.connection
+
+    def _setup(self, _: Connection):
+        self._migrate()
+        self._database.execute("PRAGMA foreign_keys = ON")
+
+    def _migrate(self):
+        """Bring the schema up to `_version`, every missing step runs in one transaction"""
+        version = self._database.execute("PRAGMA user_version").fetchone()[0]
+        if version >= self._version:
+            return
+
+        self._database.execute("BEGIN")
+        try:
+            if version < 1:
+                self._migrate_tags()
+            if version < 2:
+                self._migrate_fts()
+            if version < 3:
+                self._migrate_library()
+
+            self._database.execute(f"PRAGMA user_version = {self._version}")
             self._database.commit()
-            cursor.close()
-        else:
-            self._database = connect("../telegraph.db")
+        except BaseException:
+            self._database.rollback()
+            raise
+
+    def _migrate_tags(self):
+        """Create the tables, or move an old database with tags in JSON columns to the tag tables"""
+        tables = {r[0] for r in self._database.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+        if 'telegraph' in tables:
+            # rebuilt without the foreign key to the old `tag` table
+            self._database.execute("ALTER TABLE telegraph RENAME TO telegraph_old")
+            self._database.execute("DROP INDEX IF EXISTS idx_telegraph_tag_id")
+            self._database.execute("DROP INDEX IF EXISTS idx_telegraph_name")
+
+        self._database.execute(
+            """
+            CREATE TABLE telegraph (
+                tag_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                time_added DATE,
+                title VARCHAR(100) NOT NULL,
+                original_url VARCHAR(200),
+                preview_url VARCHAR(200),
+                file_location VARCHAR(200)
+            );
+            """
+        )
+        self._database.execute(
+            """
+            CREATE TABLE tags (
+                id INTEGER PRIMARY KEY,
+                namespace TEXT NOT NULL,
+                value TEXT NOT NULL COLLATE NOCASE,
+                UNIQUE (namespace, value)
+            );
+            """
+        )
+        self._database.execute(
+            """
+            CREATE TABLE gallery_tags (
+                gallery_id INTEGER NOT NULL REFERENCES telegraph(tag_id) ON DELETE CASCADE,
+                tag_id INTEGER NOT NULL REFERENCES tags(id),
+                PRIMARY KEY (gallery_id, tag_id)
+            ) WITHOUT ROWID;
+            """
+        )
+        self._database.execute("CREATE INDEX idx_telegraph_name ON telegraph (title)")
+        self._database.execute("CREATE INDEX idx_tags_value ON tags (value)")
+        self._database.execute("CREATE INDEX idx_gallery_tags_tag ON gallery_tags (tag_id, gallery_id)")
+
+        if 'telegraph' in tables:
+            self._database.execute("INSERT INTO telegraph SELECT * FROM telegraph_old")
+            self._database.execute("DROP TABLE telegraph_old")
+
+        if 'tag' in tables:
+            # tags were saved as python reprs like "['a', 'b']" or "None"
+            rows = self._database.execute(
+                "SELECT telegraph_id, lang, artist, team, original, characters, male, female, others FROM tag"
+            ).fetchall()
+            for row in rows:
+                self._set_tags(row[0], {n: self._parse_legacy(v) for n, v in zip(self._namespaces, row[1:])})
+
+            self._database.execute("DROP TABLE tag")
+            logger.info(f"[TelegraphDatabase]: Migrated tags of {len(rows)} galleries to the tag tables")
+
+    def _migrate_fts(self):
+        """Full-text index of titles and tags, kept in sync by triggers"""
+        columns = ['title', *self._fts_namespaces]
+        self._database.execute(
+            f"CREATE VIRTUAL TABLE telegraph_fts USING fts5({', '.join(columns)}, tokenize = 'trigram')")
+
+        # tag columns hold every tag of the namespace separated by ' / '
+        tags = ', '.join(
+            f"{n} = (SELECT group_concat(value, ' / ') FROM gallery_tags JOIN tags ON tag_id = tags.id "
+            f"WHERE gallery_id = {{0}} AND namespace = '{n}')"
+            for n in self._fts_namespaces
+        )
+        triggers = [
+            """
+            CREATE TRIGGER telegraph_fts_insert AFTER INSERT ON telegraph BEGIN
+                INSERT INTO telegraph_fts (rowid, title) VALUES (new.tag_id, new.title);
+            END;
+            """,
+            """
+            CREATE TRIGGER telegraph_fts_update AFTER UPDATE OF title ON telegraph BEGIN
+                UPDATE telegraph_fts SET title = new.title WHERE rowid = new.tag_id;
+            END;
+            """,
+            """
+            CREATE TRIGGER telegraph_fts_delete AFTER DELETE ON telegraph BEGIN
+                DELETE FROM telegraph_fts WHERE rowid = old.tag_id;
+            END;
+            """,
+            f"""
+            CREATE TRIGGER gallery_tags_fts_insert AFTER INSERT ON gallery_tags BEGIN
+                UPDATE telegraph_fts SET {tags.format('new.gallery_id')} WHERE rowid = new.gallery_id;
+            END;
+            """,
+            f"""
+            CREATE TRIGGER gallery_tags_fts_delete AFTER DELETE ON gallery_tags BEGIN
+                UPDATE telegraph_fts SET {tags.format('old.gallery_id')} WHERE rowid = old.gallery_id;
+            END;
+            """,
+        ]
+        [self._database.execute(trigger) for trigger in triggers]
+
+        self._database.execute("INSERT INTO telegraph_fts (rowid, title) SELECT tag_id, title FROM telegraph")
+        self._database.execute(f"UPDATE telegraph_fts SET {tags.format('telegraph_fts.rowid')}")
+
+    def _migrate_library(self):
+        """Archives found by LibraryIndexer, with the size and mtime they had when they were read"""
+        self._database.execute(
+            """
+            CREATE TABLE library (
+                path TEXT PRIMARY KEY,
+                gallery_id INTEGER NOT NULL REFERENCES telegraph(tag_id) ON DELETE CASCADE,
+                created INTEGER NOT NULL DEFAULT 0,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                pages INTEGER,
+                cover_sha256 TEXT,
+                comic_info JSON,
+                time_indexed DATE
+            );
+            """
+        )
+        self._database.execute("CREATE INDEX idx_library_gallery ON library (gallery_id)")
+        self._database.execute("CREATE INDEX idx_library_cover ON library (cover_sha256)")
+        self._database.execute("CREATE INDEX idx_telegraph_file_location ON telegraph (file_location)")
+
+    @staticmethod
+    def _parse_legacy(raw: Optional[str]) -> List[str]:
+        try:
+            value = literal_eval(raw) if raw else None
+        except (ValueError, SyntaxError):
+            value = raw
+
+        if value is None:
+            return []
+
+        return [str(v) for v in value] if isinstance(value, (list, tuple)) else [str(value)]
+
+    def _set_tags(self, gallery_id: int, tags: Dict[str, Optional[List[str]]]):
+        """Link tags to a gallery, the caller commits"""
+        for namespace, values in tags.items():
+            for value in dict.fromkeys(v.strip() for v in values or [] if v and v.strip()):
+                self._database.execute(
+                    "INSERT OR IGNORE INTO tags (namespace, value) VALUES (?, ?)", (namespace, value))
+                self._database.execute(
+                    """
+                    INSERT OR IGNORE INTO gallery_tags (gallery_id, tag_id)
+                    SELECT ?, id FROM tags WHERE namespace = ? AND value = ?
+                    """,
+                    (gallery_id, namespace, value)
+                )
+
+    def _tag_condition(self, tag: str, column: str = 'tag_id') -> Tuple[str, Tuple]:
+        """Condition on a gallery_tags column matching one tag, written as 'value' for any namespace or 'namespace:value'"""
+        namespace, _, value = tag.partition(':')
+        if value and namespace in self._namespaces:
+            return f"{column} = (SELECT id FROM tags WHERE namespace = ? AND value = ?)", (namespace, value.strip())
+
+        return f"{column} IN (SELECT id FROM tags WHERE value = ?)", (tag.strip(),)
+
+    def _tag_query(self, tag: str) -> Tuple[str, Tuple]:
+        """Galleries with one tag"""
+        condition, params = self._tag_condition(tag)
+        return f"SELECT gallery_id FROM gallery_tags WHERE {condition}", params
+
+    def _text_query(self, key: str, columns: List[str]) -> Tuple[List[str], List[str]]:
+        """
+        Conditions on telegraph_fts matching every word of `key` in any of `columns`.
+        Words of 3 or more characters use the trigram index, shorter ones (common in CJK names) fall back to LIKE.
+        """
+        words = key.split()
+        where, params = [], []
+
+        phrases = ['"' + w.replace('"', '""') + '"' for w in words if len(w) >= 3]
+        if phrases:
+            where.append("telegraph_fts MATCH ?")
+            params.append(f"{{{' '.join(columns)}}} : ({' AND '.join(phrases)})")
+
+        for word in (w for w in words if len(w) < 3):
+            pattern = '%' + word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            where.append('(' + ' OR '.join(f"telegraph_fts.{c} LIKE ? ESCAPE '\\'" for c in columns) + ')')
+            params += [pattern] * len(columns)
+
+        return where, params
 
     def new(self, data: Union[Dict, List]) -> TelegraphData:
         """
@@ -478,36 +765,112 @@ class TelegraphDatabase:
 
             data.title = telegraph_task.title
 
-        cursor = self._database.cursor()
+        await self._db.transaction(self._insert, data)
+        logger.info(f"[Telegraph]: Add {data.title} to telegraph database")
+
+    async def insert_many(self, data: List[TelegraphData]) -> List[int]:
+        """Insert filled data in one transaction and return their ids, nothing is inserted if one fails."""
+        ids = await self._db.transaction(lambda: [self._insert(d) for d in data])
+        logger.info(f"[Telegraph]: Add {len(ids)} galleries to telegraph database")
+        return ids
+
+    def _insert(self, data: TelegraphData) -> int:
+        # a library scan may have found the archive first, the gallery it created takes the title and tags given here
+        adopted = self._database.execute(
+            """
+            SELECT tag_id FROM telegraph JOIN library ON library.gallery_id = telegraph.tag_id
+            WHERE telegraph.file_location = ? AND library.created = 1 ORDER BY tag_id LIMIT 1
+            """,
+            (data.file_location,)
+        ).fetchone() if data.file_location else None
+        if adopted:
+            self._database.execute(
+                """
+                UPDATE telegraph SET title = ?, original_url = COALESCE(?, original_url),
+                preview_url = COALESCE(?, preview_url) WHERE tag_id = ?
+                """,
+                (data.title, data.original_url, data.preview_url, adopted[0])
+            )
+            self._database.execute("DELETE FROM gallery_tags WHERE gallery_id = ?", (adopted[0],))
+            self._set_tags(adopted[0], {n: getattr(data, n) for n in self._namespaces})
+            # later scans keep the gallery as it is now
+            self._database.execute("UPDATE library SET created = 0 WHERE gallery_id = ?", (adopted[0],))
+            return adopted[0]
+
         telegraph_script = \
             """
             INSERT INTO telegraph (time_added, title, original_url, preview_url, file_location)
             VALUES (?, ?, ?, ?, ?)
             """
-        tag_script = \
-            """
-            INSERT INTO tag (lang, artist, team, original, characters, male, female, others)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """
-        cursor.execute(telegraph_script, (
+        cursor = self._database.execute(telegraph_script, (
             datetime.today(), data.title,
             data.original_url, data.preview_url, data.file_location))
-        cursor.execute(tag_script, (
-            f'{data.language}', f'{data.artist}', f'{data.team}', f'{data.original}',
-            f'{data.characters}', f'{data.male}', f'{data.female}', f'{data.others}'
-        ))
-        self._database.commit()
-        logger.info(f"[Telegraph]: Add {data.title} to telegraph database")
-        cursor.close()
+        self._set_tags(cursor.lastrowid, {n: getattr(data, n) for n in self._namespaces})
+        return cursor.lastrowid
 
-    async def remove(self, idx: int):
-        """Delete a Telegraph entry."""
-        cursor = self._database.cursor()
-        script = ["DELETE FROM telegraph WHERE tag_id = ?", "DELETE FROM tag WHERE telegraph_id = ?"]
-        [cursor.execute(script, (idx,)) for script in script]
+    async def library_checkpoints(self) -> Dict[str, Tuple[int, float]]:
+        """Size and mtime of every indexed archive, keyed by path"""
+        return {r[0]: (r[1], r[2]) for r in await self._db.execute("SELECT path, size, mtime FROM library")}
 
-        self._database.commit()
-        cursor.close()
+    async def index_archives(self, archives: List[Tuple[TelegraphData, Any]]):
+        """
+        Record archives read by LibraryIndexer in one transaction.
+
+        Args:
+            archives: (TelegraphData, Archive) 对，已有相同 file_location 的条目只更新档案信息，保留原标题和标签
+        """
+
+        def index():
+            for data, archive in archives:
+                row = self._database.execute(
+                    "SELECT tag_id FROM telegraph WHERE file_location = ? ORDER BY tag_id LIMIT 1",
+                    (data.file_location,)
+                ).fetchone()
+                created = self._database.execute(
+                    "SELECT created FROM library WHERE path = ?", (archive.path,)).fetchone()
+                if row and created and created[0]:
+                    # galleries created by the indexer follow the metadata of their archive
+                    self._database.execute("UPDATE telegraph SET title = ? WHERE tag_id = ?", (data.title, row[0]))
+                    self._database.execute("DELETE FROM gallery_tags WHERE gallery_id = ?", (row[0],))
+                    self._set_tags(row[0], {n: getattr(data, n) for n in self._namespaces})
+
+                self._database.execute(
+                    """
+                    INSERT OR REPLACE INTO library
+                    (path, gallery_id, created, size, mtime, pages, cover_sha256, comic_info, time_indexed)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        archive.path, row[0] if row else self._insert(data), created[0] if created else int(not row),
+                        archive.size, archive.mtime, archive.pages, archive.cover_sha256,
+                        json.dumps(archive.comic_info, ensure_ascii = False) if archive.comic_info else None,
+                        datetime.today()
+                    )
+                )
+
+        await self._db.transaction(index)
+        logger.info(f"[TelegraphDatabase]: Indexed {len(archives)} archives")
+
+    async def forget_archives(self, paths: List[str]) -> int:
+        """Drop archives that are gone, with the galleries the indexer created for them, return how many"""
+
+        def forget():
+            count = 0
+            for start in range(0, len(paths), 500):
+                chunk = paths[start:start + 500]
+                marks = ','.join('?' * len(chunk))
+                created = [r[0] for r in self._database.execute(
+                    f"SELECT gallery_id FROM library WHERE created = 1 AND path IN ({marks})", chunk)]
+                count += self._database.execute(f"DELETE FROM library WHERE path IN ({marks})", chunk).rowcount
+                self._database.execute(
+                    f"DELETE FROM telegraph WHERE tag_id IN ({','.join('?' * len(created))})", created)
+            return count
+
+        return await self._db.transaction(forget)
+
+    async def remove(self, idx: int):
+        """Delete a Telegraph entry, its tag links go with it."""
+        await self._db.execute("DELETE FROM telegraph WHERE tag_id = ?", (idx,))
 
     async def modify(self, table: int, attr: int, idx: int, elem: str | List[str]):
         """
@@ -518,86 +881,324 @@ class TelegraphDatabase:
                     file_location = 5, telegraph_id = 6, lang = 7, artist = 8, team = 9,
                     original = 10, characters = 11, male = 12, female = 13, others = 14
         :param idx primary key index number
-        :param elem see members in TelegraphData()
+        :param elem see members in TelegraphData(), tags replace every tag of that namespace
         """
-        if (table == 0 and attr > 5) or (table == 1 and attr < 6):
+        if (table == 0 and attr > 5) or (table == 1 and attr < 7):
             raise Exception(f"No attribute {attr} in {table}.")
 
-        cursor = self._database.cursor()
-        script = \
-            f"""
-            UPDATE {'telegraph' if table == 0 else 'tag'} SET {self._attrs[attr]} = ?
-            WHERE {'tag_id' if table == 0 else 'telegraph_id'} = ?
-            """
+        await self._db.transaction(self._modify, table, attr, idx, elem)
 
-        cursor.execute(script, (idx, elem))
-        self._database.commit()
-        cursor.close()
+    def _modify(self, table: int, attr: int, idx: int, elem: str | List[str]):
+        if table == 0:
+            self._database.execute(f"UPDATE telegraph SET {self._attrs[attr]} = ? WHERE tag_id = ?", (elem, idx))
+        else:
+            namespace = self._namespaces[attr - 7]
+            self._database.execute(
+                "DELETE FROM gallery_tags WHERE gallery_id = ? AND tag_id IN (SELECT id FROM tags WHERE namespace = ?)",
+                (idx, namespace)
+            )
+            self._set_tags(idx, {namespace: [elem] if isinstance(elem, str) else elem})
 
     async def check_health(self):
-        cursor = self._database.cursor()
-
-        if not (cursor.execute("PRAGMA integrity_check").fetchall())[0][0] == 'ok':
-            cursor.close()
+        if not (await self._db.execute("PRAGMA integrity_check"))[0][0] == 'ok':
             raise Exception("Database health check failed.")
 
-        cursor.close()
-
     async def disconnect(self):
-        self._database.close()
+        """Close the connection shared by every instance of this file"""
+        await self._db.close()
+
+    def _select(self, script: str, parameters) -> List[Optional[TelegraphData]]:
+        return self._return_search_result(self._database.execute(script, parameters))
+
+    def _load_tags(self, ids: List[int]) -> Dict[int, Dict[str, List[str]]]:
+        """Tags of every gallery in `ids`, looked up in chunks to stay under sqlite's variable limit"""
+        tags: Dict[int, Dict[str, List[str]]] = {}
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            for gallery_id, namespace, value in self._database.execute(
+                    f"""
+                    SELECT gallery_id, namespace, value FROM gallery_tags
+                    JOIN tags ON gallery_tags.tag_id = tags.id
+                    WHERE gallery_id IN ({','.join('?' * len(chunk))})
+                    """,
+                    chunk
+            ):
+                tags.setdefault(gallery_id, {}).setdefault(namespace, []).append(value)
+
+        return tags
 
     def _return_search_result(self, cursor: Cursor) -> List[Optional[TelegraphData]]:
         result = cursor.fetchall()
-        self._database.commit()
         cursor.close()
-        return [self.TelegraphData(**{k: r[i] for i, k in enumerate(self._attrs) if k in self._attrs}) for r in result]
+
+        tags = self._load_tags([r[0] for r in result])
+        return [
+            self.TelegraphData(
+                title = r[2], file_location = r[5], tag_id = r[0], telegraph_id = r[0], time_added = r[1],
+                original_url = r[3], preview_url = r[4], **tags.get(r[0], {})
+            ) for r in result
+        ]
 
     async def search_by_title(self, key: str) -> List[Optional[TelegraphData]]:
-        cursor = self._database.cursor()
+        where, params = self._text_query(key, ['title'])
+        if not where:
+            return []
+
         script = \
+            f"""
+            SELECT telegraph.* FROM telegraph_fts
+            JOIN telegraph ON telegraph.tag_id = telegraph_fts.rowid
+            WHERE {' AND '.join(where)}
+            ORDER BY telegraph.tag_id;
             """
-            SELECT * FROM telegraph
-            JOIN tag ON telegraph.tag_id = tag.telegraph_id
-            WHERE title LIKE ?;
+        return await self._db.run(self._select, script, params)
+
+    async def search(self, key: str, limit: int = 20, offset: int = 0) -> List[Optional[TelegraphData]]:
+        """
+        Full-text search over titles and artist, team, original and character tags, best matches first.
+
+        Args:
+            key: 关键词，空格分隔的每个词都需要匹配，不区分大小写
+            limit: 每页结果数
+            offset: 跳过的结果数，用于翻页
+        """
+        columns = ['title', *self._fts_namespaces]
+        where, params = self._text_query(key, columns)
+        if not where:
+            return []
+
+        # title hits weigh most, bm25 needs a MATCH so LIKE-only queries list the newest first
+        ranked = where[0].startswith('telegraph_fts MATCH')
+        script = \
+            f"""
+            SELECT telegraph.* FROM telegraph_fts
+            JOIN telegraph ON telegraph.tag_id = telegraph_fts.rowid
+            WHERE {' AND '.join(where)}
+            ORDER BY {'bm25(telegraph_fts, 10.0, 5.0, 3.0, 2.0, 2.0)' if ranked else 'telegraph.tag_id DESC'}
+            LIMIT ? OFFSET ?;
             """
-        cursor.execute(script, (f"%{key}%",))
-        return self._return_search_result(cursor)
+        return await self._db.run(self._select, script, [*params, limit, offset])
 
     async def search_by_tag(self, key: str) -> List[Optional[TelegraphData]]:
-        cursor = self._database.cursor()
+        return await self.search_by_tags([key])
+
+    async def search_by_tags(self, tags: List[str], match_all: bool = True) -> List[Optional[TelegraphData]]:
+        """
+        Galleries with all of `tags`, or with any of them when `match_all` is False.
+
+        Args:
+            tags: 标签列表，'value' 匹配任意命名空间，'namespace:value' 只匹配该命名空间，如 'artist:name'
+            match_all: True 为 AND 查询，False 为 OR 查询
+        """
+        if not tags:
+            return []
+
+        queries = [self._tag_query(tag) for tag in tags]
         script = \
-            """
+            f"""
             SELECT * FROM telegraph
-            WHERE tag_id = (
-                SELECT telegraph_id FROM tag
-                WHERE EXISTS (
-                    SELECT 1
-                    FROM (
-                        SELECT * FROM json_each(lang) UNION ALL
-                        SELECT * FROM json_each(artist) UNION ALL
-                        SELECT * FROM json_each(team) UNION ALL
-                        SELECT * FROM json_each(original) UNION ALL
-                        SELECT * FROM json_each(characters) UNION ALL
-                        SELECT * FROM json_each(male) UNION ALL
-                        SELECT * FROM json_each(female) UNION ALL
-                        SELECT * FROM json_each(others)
-                    ) AS keywords
-                    WHERE keywords.value = ?
-                )
-            );
+            WHERE tag_id IN ({(' INTERSECT ' if match_all else ' UNION ').join(q[0] for q in queries)})
+            ORDER BY tag_id;
             """
-        cursor.execute(script, (key,))
-        return self._return_search_result(cursor)
+        return await self._db.run(self._select, script, [p for q in queries for p in q[1]])
+
+    @staticmethod
+    def _encode_cursor(*key) -> str:
+        return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+    @staticmethod
+    def _decode_cursor(cursor: str, size: int) -> List:
+        try:
+            key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except (ValueError, TypeError):
+            raise ValueError(f"Invalid cursor: {cursor}")
+
+        if not isinstance(key, list) or len(key) != size:
+            raise ValueError(f"Invalid cursor: {cursor}")
+        return key
+
+    def _page(self, script: str, parameters: List, limit: int, key: Callable[[tuple], tuple]) -> Page:
+        """
+        Run a keyset query with `LIMIT limit + 1` appended, the extra row only tells whether a next page exists.
+        `key` gives the cursor values of a raw row, columns after the ones of `telegraph` are only used by `key`.
+        """
+        rows = self._database.execute(f"{script} LIMIT ?", [*parameters, limit + 1]).fetchall()
+        more, rows = len(rows) > limit, rows[:limit]
+
+        tags = self._load_tags([r[0] for r in rows])
+        return self.Page(
+            [self.TelegraphRow(*r[:6], tags.get(r[0], {})) for r in rows],
+            self._encode_cursor(*key(rows[-1])) if more else None
+        )
+
+    async def search_page(self, key: str, limit: int = 20, cursor: Optional[str] = None) -> Page:
+        """
+        Like search(), one page at a time with a cursor instead of an offset, so later pages cost the same as the first.
+
+        Args:
+            key: 搜索词
+            limit: 每页结果数
+            cursor: 上一页返回的 cursor，None 为第一页
+        """
+        columns = ['title', *self._fts_namespaces]
+        where, params = self._text_query(key, columns)
+        if not where:
+            return self.Page([], None)
+
+        if where[0].startswith('telegraph_fts MATCH'):
+            rank = 'bm25(telegraph_fts, 10.0, 5.0, 3.0, 2.0, 2.0)'
+            if cursor:
+                last_rank, last_id = self._decode_cursor(cursor, 2)
+                where.append(f"({rank} > ? OR ({rank} = ? AND telegraph.tag_id > ?))")
+                params += [last_rank, last_rank, last_id]
+            order, key_of = f"{rank}, telegraph.tag_id", lambda r: (r[6], r[0])
+        else:
+            if cursor:
+                where.append("telegraph.tag_id < ?")
+                params += self._decode_cursor(cursor, 1)
+            rank, order, key_of = 'NULL', 'telegraph.tag_id DESC', lambda r: (r[0],)
 
-    async def random(self):
-        cursor = self._database.cursor()
         script = \
+            f"""
+            SELECT telegraph.*, {rank} FROM telegraph_fts
+            JOIN telegraph ON telegraph.tag_id = telegraph_fts.rowid
+            WHERE {' AND '.join(where)}
+            ORDER BY {order}
             """
-            SELECT * FROM telegraph
-            JOIN tag ON telegraph.tag_id = tag.telegraph_id
-            WHERE tag_id = ?
-            ORDER BY random()
-            LIMIT 1
+        return await self._db.run(self._page, script, params, limit, key_of)
+
+    async def tags_page(
+            self,
+            tags: List[str],
+            match_all: bool = True,
+            limit: int = 20,
+            cursor: Optional[str] = None
+    ) -> Page:
+        """
+        Like search_by_tags(), one page at a time from the newest gallery.
+
+        Args:
+            tags: 标签列表，写法同 search_by_tags()
+            match_all: True 为 AND 查询，False 为 OR 查询
+            limit: 每页结果数
+            cursor: 上一页返回的 cursor，None 为第一页
+        """
+        if not tags:
+            return self.Page([], None)
+
+        after = self._decode_cursor(cursor, 1)[0] if cursor else None
+        return await self._db.run(self._tags_page, tags, match_all, limit, after)
+
+    def _tags_page(self, tags: List[str], match_all: bool, limit: int, after: Optional[int]) -> Page:
+        """
+        Every tag id a page can come from is read from idx_gallery_tags_tag in gallery order and merged, so a page
+        costs the same however many galleries match. With `match_all` those are the ids of the first tag, and the
+        other tags are checked per gallery.
+        """
+        ids = []
+        for tag in tags:
+            condition, params = self._tag_condition(tag, 'id')
+            ids.append([r[0] for r in self._database.execute(f"SELECT id FROM tags WHERE {condition}", params)])
+
+        sources, required = (ids[0], ids[1:]) if match_all else ([i for group in ids for i in group], [])
+        if not sources or not all(required):
+            return self.Page([], None)
+
+        condition = ''.join(
+            f" AND EXISTS (SELECT 1 FROM gallery_tags WHERE gallery_id = g.gallery_id "
+            f"AND tag_id IN ({','.join('?' * len(group))}))"
+            for group in required
+        )
+        arm = \
+            f"""
+            SELECT g.gallery_id FROM gallery_tags AS g
+            WHERE g.tag_id = ?{' AND g.gallery_id < ?' if after is not None else ''}{condition}
+            """
+        params = [
+            p for i in sources
+            for p in (i, *([after] if after is not None else []), *(t for group in required for t in group))
+        ]
+        # only ids are merged and cut to the page, the galleries are joined afterwards
+        script = \
+            f"""
+            SELECT telegraph.* FROM ({' UNION '.join([arm] * len(sources))} ORDER BY 1 DESC LIMIT ?) AS page
+            JOIN telegraph ON telegraph.tag_id = page.gallery_id
+            ORDER BY telegraph.tag_id DESC
+            """
+        return self._page(script, [*params, limit + 1], limit, lambda r: (r[0],))
+
+    async def _stream(self, page: Callable, *args, page_size: int = 100) -> AsyncIterator[TelegraphRow]:
+        cursor = None
+        while True:
+            result = await page(*args, limit = page_size, cursor = cursor)
+            for row in result.rows:
+                yield row
+            if not (cursor := result.cursor):
+                return
+
+    def iter_search(self, key: str, page_size: int = 100) -> AsyncIterator[TelegraphRow]:
+        """Every result of search_page(), fetched one page at a time as the caller iterates"""
+        return self._stream(self.search_page, key, page_size = page_size)
+
+    def iter_by_tags(self, tags: List[str], match_all: bool = True, page_size: int = 100) -> AsyncIterator[TelegraphRow]:
+        """Every result of tags_page(), fetched one page at a time as the caller iterates"""
+        return self._stream(self.tags_page, tags, match_all, page_size = page_size)
+
+    async def random(
+            self,
+            count: int = 1,
+            tags: Optional[List[str]] = None,
+            language: Optional[str] = None
+    ) -> List[Optional[TelegraphData]]:
+        """
+        Up to `count` distinct galleries, each gallery matching the filters is equally likely.
+
+        Args:
+            count: 返回的条目数，符合条件的条目不足时全部返回
+            tags: 必须全部包含的标签，写法同 search_by_tags()
+            language: 语言标签，如 'chinese'
+        """
+        filters = [*(tags or []), *([f"language:{language}"] if language else [])]
+        ids = await self._db.run(self._random_ids, count, filters)
+        if not ids:
+            return []
+
+        found = {
+            d.tag_id: d for d in await self._db.run(
+                self._select, f"SELECT * FROM telegraph WHERE tag_id IN ({','.join('?' * len(ids))})", ids)
+        }
+        return [found[i] for i in ids if i in found]
+
+    def _random_ids(self, count: int, filters: List[str], rounds: int = 8) -> List[int]:
+        """
+        Draw ids uniformly between the smallest and largest tag_id and keep those of existing galleries matching
+        `filters`, every probe is one primary key lookup so the cost does not grow with the table. Deleted ids and
+        rare filters make most probes miss, then the matching ids are listed and sampled instead.
+        """
+        low, high = self._database.execute("SELECT min(tag_id), max(tag_id) FROM telegraph").fetchone()
+        if low is None or count < 1:
+            return []
+
+        queries = [self._tag_query(tag) for tag in filters]
+        condition = ''.join(f" AND EXISTS ({q[0]} AND gallery_id = telegraph.tag_id)" for q in queries)
+        params = [p for q in queries for p in q[1]]
+
+        picked: Dict[int, None] = {}
+        for _ in range(rounds):
+            probes = list(dict.fromkeys(randint(low, high) for _ in range(min(max(64, count * 4), 500))))
+            hits = {r[0] for r in self._database.execute(
+                f"SELECT tag_id FROM telegraph WHERE tag_id IN ({','.join('?' * len(probes))}){condition}",
+                [*probes, *params]
+            )}
+            # keep the draw order, sorted ids would favour small ones when more than `count` hit
+            picked.update((i, None) for i in probes if i in hits and i not in picked)
+            if len(picked) >= count:
+                return list(picked)[:count]
+
+        script = \
+            f"""
+            SELECT tag_id FROM telegraph
+            {f"WHERE tag_id IN ({' INTERSECT '.join(q[0] for q in queries)})" if queries else ''}
             """
-        cursor.execute(script, (randint(0, 100),))
-        return self._return_search_result(cursor)
+        matched = [r[0] for r in self._database.execute(script, params)]
+        return sample(matched, min(count, len(matched)))
@@ -1,5 +1,9 @@
 # __init__.py
 
+from .client import client_init, get_client, close_clients
+from .database import AsyncSQLite
 from .env import EnvironmentReader
+from .limiter import AdaptiveLimiter, limiter_init, get_limiter, limiters
 from .logger import logger
+from .metrics import metrics_init
 from .proxy import proxy_init
@@ -0,0 +1,63 @@
+from importlib.util import find_spec
+from typing import Dict, Optional, Tuple
+
+from httpx import URL, AsyncClient, Limits, Proxy
+
+from .logger import logger
+
+# http/2 is only negotiated when the optional 'h2' package is installed
+_http2 = find_spec('h2') is not None
+_limits = Limits(max_connections = 100, max_keepalive_connections = 20, keepalive_expiry = 30.)
+_clients: Dict[Tuple[str, Optional[str], Optional[Tuple[str, str]]], AsyncClient] = {}
+
+
+def client_init(
+        max_connections: int = 100,
+        max_keepalive: int = 20,
+        keepalive_expiry: float = 30.,
+        http2: bool = True
+):
+    """
+    Configure connection pools used by every client created after this call.
+
+    Args:
+        max_connections: 单个主机连接池的最大连接数
+        max_keepalive: 单个主机连接池保持的空闲连接数
+        keepalive_expiry: 空闲连接的保持时间（秒）
+        http2: 在主机支持时启用 HTTP/2
+    """
+    global _http2, _limits
+
+    _http2 = http2 and find_spec('h2') is not None
+    _limits = Limits(
+        max_connections = max_connections,
+        max_keepalive_connections = max_keepalive,
+        keepalive_expiry = keepalive_expiry
+    )
+
+    if http2 and not _http2:
+        logger.warning("[Client]: Package 'h2' not installed, fallback to HTTP/1.1")
+
+
+def get_client(url: URL | str, proxy: Optional[Proxy] = None) -> AsyncClient:
+    """
+    Get the shared client for the host of `url`, one connection pool for each host and proxy.
+
+    Headers, cookies and timeouts should be passed per request, the client is shared by all callers.
+    """
+    url = URL(url) if isinstance(url, str) else url
+    key = (url.host, str(proxy.url) if proxy else None, proxy.auth if proxy else None)
+
+    if key not in _clients or _clients[key].is_closed:
+        logger.debug(f"[Client]: New connection pool for '{url.host}'")
+        _clients[key] = AsyncClient(proxy = proxy, limits = _limits, http2 = _http2)
+
+    return _clients[key]
+
+
+async def close_clients():
+    """Close all shared clients, call it once when the bot shuts down."""
+    for client in _clients.values():
+        await client.aclose()
+
+    _clients.clear()
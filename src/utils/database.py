@@ -0,0 +1,91 @@
+import asyncio
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from sqlite3 import Connection, connect
+from typing import Any, Callable, Dict, List, Optional
+
+from .logger import logger
+
+
+class AsyncSQLite:
+    """
+    One sqlite connection in WAL mode, owned by a dedicated thread.
+
+    Every call is sent to that thread and awaited, so slow disks never block the event loop and calls run one at a
+    time in the order they were made. The connection keeps up to `cached_statements` prepared statements, keyed by
+    their SQL text, so queries should pass values as parameters.
+    """
+    _shared: Dict[str, 'AsyncSQLite'] = {}
+
+    def __init__(
+            self,
+            path: str,
+            setup: Optional[Callable[[Connection], Any]] = None,
+            cached_statements: int = 256
+    ):
+        self.path = path
+        self._setup = setup
+        self._cached_statements = cached_statements
+        self._connection: Optional[Connection] = None
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix = f'sqlite-{os.path.basename(path)}')
+        self._opened: Optional[Future] = None
+
+    def _open(self):
+        self._connection = connect(self.path, cached_statements = self._cached_statements)
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        self._setup(self._connection) if self._setup else None
+
+    @classmethod
+    def shared(cls, path: str, setup: Optional[Callable[[Connection], Any]] = None) -> 'AsyncSQLite':
+        """Process-wide connection to `path`, `setup` only runs when the connection is opened"""
+        key = os.path.abspath(path)
+        if key not in cls._shared:
+            cls._shared[key] = cls(path, setup)
+
+        return cls._shared[key]
+
+    @property
+    def connection(self) -> Connection:
+        """The connection itself, only usable inside functions passed to `run()` or `transaction()`"""
+        return self._connection
+
+    def _call(self, func: Callable, *args):
+        self._opened.result()
+        return func(*args)
+
+    async def run(self, func: Callable, *args):
+        """Call `func(*args)` on the database thread"""
+        if not self._opened:
+            # opened by the first call, so `setup` can rely on its owner being fully constructed
+            self._opened = self._executor.submit(self._open)
+
+        return await asyncio.wrap_future(self._executor.submit(self._call, func, *args))
+
+    async def transaction(self, func: Callable, *args):
+        """Call `func(*args)` on the database thread in one transaction, committed when it returns"""
+
+        def run():
+            with self._connection:
+                return func(*args)
+
+        return await self.run(run)
+
+    async def execute(self, sql: str, parameters = ()) -> List[tuple]:
+        """Run one statement and return its rows, writes are committed"""
+
+        def run():
+            with self._connection:
+                return self._connection.execute(sql, parameters).fetchall()
+
+        return await self.run(run)
+
+    async def close(self):
+        """Close the connection, a later `shared()` call opens a new one"""
+        if self._shared.get(os.path.abspath(self.path)) is self:
+            del self._shared[os.path.abspath(self.path)]
+
+        if self._opened:
+            await self.run(lambda: self._connection.close() if self._connection else None)
+        self._executor.shutdown(wait = False)
+        logger.debug(f"[AsyncSQLite]: Closed '{self.path}'")
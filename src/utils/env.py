@@ -23,12 +23,44 @@ class EnvironmentReader:
         self.PROXY = os.getenv('PROXY', None)
         # see https://github.com/ymyuuu/Cloudflare-Workers-Proxy
         self.CF_WORKER_PROXY = os.getenv('CF_WORKER_PROXY', None)
-        # you can not set this number too high, or you will be banned by image host services
+        # initial download concurrency for each image host, adjusted at runtime by 429/5xx rates and latency
         self.TELEGRAPH_THREADS = int(os.getenv('TELEGRAPH_THREADS', 2))
+        # upper bound the adaptive download concurrency can grow to for a single image host
+        self.TELEGRAPH_MAX_THREADS = int(os.getenv('TELEGRAPH_MAX_THREADS', 8))
+        # response time (seconds) above which an image host is treated as overloaded
+        self.TELEGRAPH_LATENCY_TARGET = float(os.getenv('TELEGRAPH_LATENCY_TARGET', 5.))
+        # galleries downloaded at the same time, in total and for a single image host
+        self.TELEGRAPH_JOBS = int(os.getenv('TELEGRAPH_JOBS', 2))
+        self.TELEGRAPH_JOBS_PER_HOST = int(os.getenv('TELEGRAPH_JOBS_PER_HOST', 2))
+        # download dirs in /neko/.temp unused for longer than this (hours) are removed
+        self.TEMP_MAX_AGE = float(os.getenv('TEMP_MAX_AGE', 24.))
+        # least recently used download dirs are removed once /neko/.temp grows over this (MB), 0 for no limit
+        self.TEMP_MAX_SIZE = int(os.getenv('TEMP_MAX_SIZE', 4096))
+        # hours between scans of /neko/komga and /neko/epub for archives to index, 0 to disable
+        self.LIBRARY_SCAN_INTERVAL = float(os.getenv('LIBRARY_SCAN_INTERVAL', 6.))
+        # archives read at the same time during a scan
+        self.LIBRARY_SCAN_WORKERS = int(os.getenv('LIBRARY_SCAN_WORKERS', 4))
+        # seconds a reverse search engine may take before its results are dropped, 0 to wait for every engine
+        self.SEARCH_ENGINE_DEADLINE = float(os.getenv('SEARCH_ENGINE_DEADLINE', 15.)) or None
+        # downsize and re-encode images to what each search engine needs before uploading, set 'false' to send originals
+        self.SEARCH_NORMALIZE = os.getenv('SEARCH_NORMALIZE', 'true').lower() not in ('0', 'false', 'no')
+        # hours reverse search results of an image are reused, 0 to disable the cache
+        self.SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL', 168.))
+        # images whose perceptual hashes differ in up to this many bits (of 64) share results, at most 3 is exact
+        self.SEARCH_CACHE_DISTANCE = int(os.getenv('SEARCH_CACHE_DISTANCE', 3))
+        # serve Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics, disabled when port is not set
+        self.METRICS_PORT = int(os.getenv('METRICS_PORT', 0)) or None
+        self.METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+        # connection pool limits for each outbound host, shared by all services
+        self.HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 100))
+        self.HTTP_MAX_KEEPALIVE = int(os.getenv('HTTP_MAX_KEEPALIVE', 20))
+        self.HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', 30.))
+        # negotiate HTTP/2 with hosts that support it, set 'false' to force HTTP/1.1
+        self.HTTP2 = os.getenv('HTTP2', 'true').lower() not in ('0', 'false', 'no')
         # no need to change
         self.BASE_URL = "https://api.telegram.org/bot"
         self.BASE_FILE_URL = "https://api.telegram.org/file/bot"
-        self.WORKING_DIRS = ['/neko/komga', '/neko/dmzj', '/neko/epub', '/neko/.temp']
+        self.WORKING_DIRS = ['/neko/komga', '/neko/dmzj', '/neko/epub', '/neko/.temp', '/neko/.blob']
         self.BOT_COMMAND = {
             '📺': "anime",
             '👋': "bye",
@@ -43,7 +75,22 @@ class EnvironmentReader:
     def print_env(self):
         logger.debug(f"[Env]: Bot Token: {self.BOT_TOKEN}")
         logger.debug(f"[Env]: Telegram user ID: {self.MY_USER_ID}")
-        logger.debug(f"[Env]: Telegraph download threads: {self.TELEGRAPH_THREADS}")
+        logger.debug(
+            f"[Env]: Telegraph download threads: {self.TELEGRAPH_THREADS} (max {self.TELEGRAPH_MAX_THREADS}, "
+            f"latency target {self.TELEGRAPH_LATENCY_TARGET}s)"
+        )
+        logger.debug(f"[Env]: Telegraph jobs: {self.TELEGRAPH_JOBS} ({self.TELEGRAPH_JOBS_PER_HOST} per host)")
+        logger.debug(f"[Env]: Temp dirs: kept {self.TEMP_MAX_AGE} hours, up to {self.TEMP_MAX_SIZE} MB")
+        logger.debug(
+            f"[Env]: Search: engine deadline {self.SEARCH_ENGINE_DEADLINE}s, normalize {self.SEARCH_NORMALIZE}, "
+            f"cache {self.SEARCH_CACHE_TTL} hours, distance {self.SEARCH_CACHE_DISTANCE}"
+        )
+        logger.debug(
+            f"[Env]: Library scan: every {self.LIBRARY_SCAN_INTERVAL} hours, {self.LIBRARY_SCAN_WORKERS} workers")
+        logger.debug(
+            f"[Env]: HTTP pool: {self.HTTP_MAX_CONNECTIONS} connections, {self.HTTP_MAX_KEEPALIVE} keep-alive, "
+            f"{self.HTTP_KEEPALIVE_EXPIRY}s expiry, HTTP/2 {'on' if self.HTTP2 else 'off'}"
+        )
 
         for key, value in [
             ("Chat Anywhere key", self.CHAT_ANYWHERE_KEY),
@@ -0,0 +1,102 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+from .logger import logger
+
+_maximum = 8
+_latency_target = 5.
+_limiters: Dict[str, 'AdaptiveLimiter'] = {}
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit for one host.
+
+    Every healthy response adds `1 / limit` to the limit, so it grows by one slot after a full window of requests.
+    A 429, a 5xx, a network error or a response slower than `latency_target` halves the limit,
+    at most once per `latency_target` seconds so one burst of failures only counts once.
+    """
+
+    def __init__(
+            self,
+            host: str,
+            initial: int = 2,
+            minimum: int = 1,
+            maximum: int = 8,
+            latency_target: float = 5.
+    ):
+        self.host = host
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self._limit = float(min(max(initial, minimum), self.maximum))
+        self._latency_target = latency_target
+        self._inflight = 0
+        self._last_decrease = 0.
+        self._condition = asyncio.Condition()
+
+    @property
+    def limit(self) -> int:
+        """Current number of requests allowed at the same time"""
+        return int(self._limit)
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._inflight < self.limit)
+            self._inflight += 1
+
+    async def release(self, latency: Optional[float] = None, status: Optional[int] = None):
+        """
+        Give back a slot and adjust the limit.
+
+        Args:
+            latency: 收到响应头所用的时间，请求失败时为 None
+            status: HTTP 状态码，网络错误时为 None
+        """
+        before = self.limit
+        congested = status is None or status == 429 or status >= 500 or \
+            (latency is not None and latency > self._latency_target)
+
+        if not congested:
+            self._limit = min(self._limit + 1 / self._limit, float(self.maximum))
+        elif time.monotonic() - self._last_decrease > self._latency_target:
+            self._limit = max(self._limit / 2, float(self.minimum))
+            self._last_decrease = time.monotonic()
+
+        if self.limit != before:
+            logger.debug(f"[Limiter]: Concurrency for '{self.host}' changed {before} -> {self.limit}")
+
+        async with self._condition:
+            self._inflight -= 1
+            self._condition.notify_all()
+
+
+def limiter_init(maximum: int = 8, latency_target: float = 5.):
+    """
+    Configure limiters created after this call.
+
+    Args:
+        maximum: 单个图床允许的最大并发数
+        latency_target: 超过此响应时间（秒）即视为拥塞
+    """
+    global _maximum, _latency_target
+
+    _maximum = maximum
+    _latency_target = latency_target
+
+
+def limiters() -> Dict[str, AdaptiveLimiter]:
+    """Limiters of every host seen so far"""
+    return dict(_limiters)
+
+
+def get_limiter(host: str, initial: int = 2) -> AdaptiveLimiter:
+    """Get the process-wide limiter of `host`, `initial` is only used when the limiter is created."""
+    if host not in _limiters:
+        _limiters[host] = AdaptiveLimiter(host, initial, maximum = _maximum, latency_target = _latency_target)
+
+    return _limiters[host]
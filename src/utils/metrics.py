@@ -0,0 +1,203 @@
+import asyncio
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .limiter import limiters
+from .logger import logger
+
+_LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+_JOB_BUCKETS = (1., 5., 15., 30., 60., 120., 300., 600., 1800., 3600.)
+_metrics: List['_Metric'] = []
+_monitor: Optional[asyncio.Task] = None
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{k}="{_escape(v)}"' for k, v in zip(names, values)]
+    pairs += [extra] if extra else []
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        _metrics.append(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}',
+                          *self.samples()])
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, value: float = 1.):
+        self._values[labels] = self._values.get(labels, 0.) + value
+
+    def value(self, *labels: str) -> float:
+        """Count of `labels`, the sum over every label set when none are given"""
+        return self._values.get(labels, 0.) if labels else sum(self._values.values())
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{_labels(self.labels, k)} {v}' for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labels: Tuple[str, ...] = (),
+            function: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None
+    ):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function = function
+
+    def set(self, *labels: str, value: float):
+        self._values[labels] = value
+
+    def set_function(self, function: Callable[[], Dict[Tuple[str, ...], float]]):
+        """Read the values from `function` at scrape time instead"""
+        self._function = function
+
+    def samples(self) -> List[str]:
+        values = self._function() if self._function else self._values
+        return [f'{self.name}{_labels(self.labels, k)} {v}' for k, v in values.items()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labels: Tuple[str, ...] = (),
+            buckets: Tuple[float, ...] = _LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labels)
+        self._buckets = buckets
+        self._values: Dict[Tuple[str, ...], List[float]] = {}  # bucket counts..., +Inf count, sum
+
+    def observe(self, *labels: str, value: float):
+        counts = self._values.setdefault(labels, [0.] * (len(self._buckets) + 2))
+        counts[bisect_left(self._buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value = time.monotonic() - start)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for k, counts in self._values.items():
+            cumulative = 0.
+            for bound, count in zip((*self._buckets, '+Inf'), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labels, k, le)} {cumulative}')
+
+            lines.append(f'{self.name}_sum{_labels(self.labels, k)} {counts[-1]}')
+            lines.append(f'{self.name}_count{_labels(self.labels, k)} {cumulative}')
+
+        return lines
+
+
+# Telegraph download workers
+DOWNLOAD_BYTES = Counter('neko_download_bytes_total', 'Bytes of images downloaded.', ('host',))
+DOWNLOAD_SECONDS = Histogram('neko_download_seconds', 'Time to download one image.', ('host',))
+DOWNLOAD_RETRIES = Counter('neko_download_retries_total', 'Image downloads retried.', ('host',))
+DOWNLOAD_FAILURES = Counter('neko_download_failures_total', 'Images given up after all retries.', ('host',))
+DOWNLOAD_CONCURRENCY = Gauge(
+    'neko_download_concurrency', 'Adaptive concurrency limit of an image host.', ('host',),
+    lambda: {(host,): limiter.limit for host, limiter in limiters().items()}
+)
+# TelegraphHandler jobs
+JOBS_QUEUED = Gauge('neko_jobs_queued', 'Telegraph jobs waiting in the queue.')
+JOBS_RUNNING = Gauge('neko_jobs_running', 'Telegraph jobs holding a scheduler slot.')
+JOBS_PARKED = Gauge('neko_jobs_parked', 'Telegraph jobs waiting without a slot for their image host.')
+JOB_SECONDS = Histogram('neko_job_seconds', 'Duration of Telegraph jobs.', ('result',), _JOB_BUCKETS)
+# AggregationSearch engines and remote APIs
+SEARCH_SECONDS = Histogram('neko_search_seconds', 'Latency of a reverse image search engine.', ('engine',))
+SEARCH_RESULTS = Counter('neko_search_total', 'Reverse image searches by result.', ('engine', 'result'))
+SEARCH_CACHE = Counter('neko_search_cache_total', 'AggregationSearch cache lookups by the tier that answered.', ('tier',))
+SEARCH_UPLOAD_BYTES = Counter('neko_search_upload_bytes_total', 'Bytes of images sent to search engines.', ('engine',))
+API_SECONDS = Histogram('neko_api_seconds', 'Latency of remote API calls.', ('api', 'call'))
+# process
+LOOP_LAG = Gauge('neko_event_loop_lag_seconds', 'Delay of the last event loop lag probe.')
+LOOP_LAG_SECONDS = Histogram('neko_event_loop_lag_probe_seconds', 'Event loop lag probes.')
+
+
+def render() -> str:
+    """All metrics in Prometheus text exposition format"""
+    return '\n'.join(m.render() for m in _metrics) + '\n'
+
+
+async def _monitor_loop_lag(interval: float = .5):
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(time.monotonic() - start - interval, 0.)
+        LOOP_LAG.set(value = lag)
+        LOOP_LAG_SECONDS.observe(value = lag)
+
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+
+        if request.split(b' ')[1:2] == [b'/metrics']:
+            body, status = render().encode(), '200 OK'
+        else:
+            body, status = b'Not Found\n', '404 Not Found'
+
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def metrics_init(port: Optional[int], host: str = '127.0.0.1') -> Optional[asyncio.Server]:
+    """
+    Serve metrics at 'http://{host}:{port}/metrics', nothing is served when port is not set.
+    Must be awaited inside the running event loop.
+    """
+    global _monitor
+
+    if not port:
+        return None
+
+    _monitor = asyncio.get_running_loop().create_task(_monitor_loop_lag())
+    server = await asyncio.start_server(_serve, host, port)
+    logger.info(f"[Metrics]: Serving Prometheus metrics at http://{host}:{port}/metrics")
+    return server